@@ -0,0 +1,67 @@
+"""Compare search engines directly against PostGIS.
+
+Usage:
+    python bench_search.py [--route-id UUID] [--radius 250 500 1000] [--runs 20]
+
+Each engine runs the same searches ``--runs`` times after one warm-up call
+and reports median and p95 latency plus the number of rows returned.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import time
+from uuid import UUID
+
+from cache import close_redis, init_redis
+from db import close_db, init_db
+from search import SEARCH_ENGINES, search_amenities
+
+SEED_ROUTE = "11111111-1111-1111-1111-111111111111"
+
+
+def log(message: str) -> None:
+    print(f"[bench] {message}")
+
+
+async def run_bench(route_id: UUID, radii: list[float], runs: int) -> None:
+    db = await init_db()
+    # The "cells" engine reads its per-tile amenities through the cache.
+    await init_redis()
+    try:
+        length_m = await db.fetchval("SELECT ST_Length(geom::geography) FROM routes WHERE route_id = $1", route_id)
+        if length_m is None:
+            raise SystemExit(f"route {route_id} not found")
+        log(f"route {route_id}: {length_m / 1000:.1f} km")
+        for radius in radii:
+            for engine in SEARCH_ENGINES:
+                rows = await search_amenities(db, route_id, radius, None, length_m, engine)
+                timings = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    await search_amenities(db, route_id, radius, None, length_m, engine)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+                log(
+                    f"radius={radius:>7.0f} engine={engine:<8} rows={len(rows):>4} "
+                    f"median={statistics.median(timings):7.2f} ms p95={p95:7.2f} ms"
+                )
+    finally:
+        await close_redis()
+        await close_db()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--route-id", type=UUID, default=UUID(SEED_ROUTE))
+    parser.add_argument("--radius", nargs="*", type=float, default=[250.0, 500.0, 1000.0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run_bench(args.route_id, args.radius, args.runs))
+
+
+if __name__ == "__main__":
+    main()
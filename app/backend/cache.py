@@ -1,15 +1,93 @@
 from __future__ import annotations
 
 import asyncio
-from typing import Any, Optional
+import logging
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+from uuid import uuid4
 
 import orjson
 from redis.asyncio import Redis
 
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 redis_client: Redis | None = None
 
+T = TypeVar("T")
+
+# Every stored value is prefixed with a version byte and the epoch time until
+# which it counts as fresh; Redis expiry marks the end of the stale window.
+_ENVELOPE = struct.Struct("!Bd")
+_ENVELOPE_VERSION = 1
+
+_MISS = object()
+
+# Compare-and-delete so a worker never releases a lock another worker re-acquired.
+_RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LocalCache:
+    """Byte-bounded in-process LRU that keeps values already decoded.
+
+    Entries carry an absolute expiry so they never outlive the Redis TTL they
+    were stored or loaded with. Cached objects are shared between callers and
+    must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[Any, int, float]] = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISS
+        value, _, expires_at = entry
+        if expires_at <= time.monotonic():
+            self.delete(key)
+            return _MISS
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, size: int, ttl: float) -> None:
+        if ttl <= 0 or size > self.max_bytes:
+            self.delete(key)
+            return
+        self.delete(key)
+        self._entries[key] = (value, size, time.monotonic() + ttl)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def delete(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+local_cache = LocalCache(settings.local_cache_max_bytes)
+_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "stale_served": 0, "refreshes": 0}
+_inflight: dict[str, asyncio.Future[Any]] = {}
+_refreshing: dict[str, asyncio.Task[Any]] = {}
+
 
 async def init_redis() -> None:
     global redis_client
@@ -30,27 +108,344 @@ def _ensure_client() -> Redis:
     return redis_client
 
 
-async def get_json(key: str) -> Optional[Any]:
+def _pack(payload: bytes, fresh_until: float) -> bytes:
+    return _ENVELOPE.pack(_ENVELOPE_VERSION, fresh_until) + payload
+
+
+def _unpack(data: bytes) -> Optional[tuple[memoryview, float]]:
+    # Values written before the envelope existed are treated as misses.
+    if len(data) < _ENVELOPE.size or data[0] != _ENVELOPE_VERSION:
+        return None
+    _, fresh_until = _ENVELOPE.unpack_from(data)
+    return memoryview(data)[_ENVELOPE.size :], fresh_until
+
+
+async def _get_redis(key: str) -> tuple[Optional[bytes], float]:
+    """Fetch a value together with its remaining TTL (seconds) in one round-trip."""
+
     client = _ensure_client()
-    data = await client.get(key)
-    if data is None:
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.get(key)
+        pipe.pttl(key)
+        data, pttl = await pipe.execute()
+    return data, max(pttl, 0) / 1000.0
+
+
+async def _lookup(key: str, decode: Callable[[memoryview], Any]) -> Optional[tuple[Any, bool]]:
+    """Return ``(value, is_fresh)`` from the nearest tier, or None on a miss."""
+
+    entry = local_cache.get(key)
+    if entry is not _MISS:
+        _stats["local_hits"] += 1
+        value, fresh_until = entry
+        return value, fresh_until > time.time()
+    data, ttl = await _get_redis(key)
+    unpacked = _unpack(data) if data is not None else None
+    if unpacked is None:
+        _stats["misses"] += 1
         return None
-    return orjson.loads(data)
+    _stats["redis_hits"] += 1
+    payload, fresh_until = unpacked
+    value = decode(payload)
+    local_cache.set(key, (value, fresh_until), len(payload), ttl)
+    return value, fresh_until > time.time()
 
 
-async def set_json(key: str, value: Any, ttl: int) -> None:
+async def _store(key: str, value: Any, payload: bytes, ttl: int, stale_ttl: int) -> None:
+    """Store a value that is fresh for ``ttl`` seconds and servable stale for ``stale_ttl`` more."""
+
     client = _ensure_client()
-    await client.set(key, orjson.dumps(value), ex=ttl)
+    fresh_until = time.time() + ttl
+    await client.set(key, _pack(payload, fresh_until), ex=ttl + stale_ttl)
+    local_cache.set(key, (value, fresh_until), len(payload), ttl + stale_ttl)
+
+
+def _decode_bytes(payload: memoryview) -> bytes:
+    return bytes(payload)
+
+
+async def get_json(key: str) -> Optional[Any]:
+    hit = await _lookup(key, orjson.loads)
+    if hit is None or not hit[1]:
+        return None
+    return hit[0]
+
+
+async def get_many_json(keys: list[str]) -> list[Optional[Any]]:
+    """Fetch several fresh JSON values, resolving local misses with one Redis MGET."""
+
+    results: list[Optional[Any]] = [None] * len(keys)
+    remote: list[int] = []
+    now = time.time()
+    for index, key in enumerate(keys):
+        entry = local_cache.get(key)
+        if entry is _MISS:
+            remote.append(index)
+            continue
+        _stats["local_hits"] += 1
+        value, fresh_until = entry
+        if fresh_until > now:
+            results[index] = value
+    if not remote:
+        return results
+
+    blobs = await _ensure_client().mget([keys[index] for index in remote])
+    for index, data in zip(remote, blobs):
+        unpacked = _unpack(data) if data is not None else None
+        if unpacked is None:
+            _stats["misses"] += 1
+            continue
+        _stats["redis_hits"] += 1
+        payload, fresh_until = unpacked
+        if fresh_until <= now:
+            continue
+        value = orjson.loads(payload)
+        # MGET carries no TTLs; keep the local copy only while it is fresh.
+        local_cache.set(keys[index], (value, fresh_until), len(payload), fresh_until - now)
+        results[index] = value
+    return results
+
+
+async def set_json(key: str, value: Any, ttl: int, stale_ttl: int = 0) -> None:
+    await _store(key, value, orjson.dumps(value), ttl, stale_ttl)
 
 
 async def get_bytes(key: str) -> Optional[bytes]:
+    hit = await _lookup(key, _decode_bytes)
+    if hit is None or not hit[1]:
+        return None
+    return hit[0]
+
+
+async def set_bytes(key: str, value: bytes, ttl: int, stale_ttl: int = 0) -> None:
+    await _store(key, value, value, ttl, stale_ttl)
+
+
+async def _store_many(items: dict[str, tuple[Any, bytes]], ttl: int, stale_ttl: int) -> None:
+    """Store several ``(value, payload)`` pairs in a single Redis round-trip."""
+
+    if not items:
+        return
     client = _ensure_client()
-    return await client.get(key)
+    fresh_until = time.time() + ttl
+    async with client.pipeline(transaction=False) as pipe:
+        for key, (_, payload) in items.items():
+            pipe.set(key, _pack(payload, fresh_until), ex=ttl + stale_ttl)
+        await pipe.execute()
+    for key, (value, payload) in items.items():
+        local_cache.set(key, (value, fresh_until), len(payload), ttl + stale_ttl)
 
 
-async def set_bytes(key: str, value: bytes, ttl: int) -> None:
+async def set_many_json(items: dict[str, Any], ttl: int, stale_ttl: int = 0) -> None:
+    await _store_many({key: (value, orjson.dumps(value)) for key, value in items.items()}, ttl, stale_ttl)
+
+
+async def set_many_bytes(items: dict[str, bytes], ttl: int, stale_ttl: int = 0) -> None:
+    await _store_many({key: (value, value) for key, value in items.items()}, ttl, stale_ttl)
+
+
+async def index_add(key: str, member: bytes, ttl: int, max_members: int) -> None:
+    """Record ``member`` in a bounded Redis index, dropping the oldest members."""
+
+    client = _ensure_client()
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.zadd(key, {member: time.time()})
+        pipe.zremrangebyrank(key, 0, -max_members - 1)
+        pipe.expire(key, ttl)
+        await pipe.execute()
+
+
+async def index_members(key: str) -> list[bytes]:
+    """Members of an index written by ``index_add``, newest first."""
+
+    return await _ensure_client().zrevrange(key, 0, -1)
+
+
+async def delete(*keys: str) -> None:
+    if not keys:
+        return
+    for key in keys:
+        local_cache.delete(key)
     client = _ensure_client()
-    await client.set(key, value, ex=ttl)
+    await client.delete(*keys)
+
+
+async def coalesce(key: str, compute: Callable[[], Awaitable[T]]) -> T:
+    """Run ``compute`` at most once per key in this process.
+
+    Concurrent callers for the same key wait on the leader's future and receive
+    its result (or exception) instead of starting their own computation.
+    """
+
+    while True:
+        future = _inflight.get(key)
+        if future is None:
+            break
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Only retry when the leader was cancelled, not this caller.
+            task = asyncio.current_task()
+            if not future.cancelled() or (task is not None and task.cancelling()):
+                raise
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await compute()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as exc:
+        future.set_exception(exc)
+        # Mark the exception as retrieved when nobody else was waiting.
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _fill_with_lock(
+    key: str,
+    compute: Callable[[], Awaitable[T]],
+    getter: Callable[[str], Awaitable[Optional[T]]],
+    setter: Callable[[T], Awaitable[None]],
+    wait_for_winner: bool = True,
+) -> Optional[T]:
+    """Compute and store a value, deduplicating across workers with a Redis lock.
+
+    Workers that lose the lock poll the cache until the winner stores the value;
+    if it does not appear before the lock timeout they compute it themselves.
+    With ``wait_for_winner`` disabled a lost lock simply returns None.
+    """
+
+    lock_key = f"lock:{key}"
+    token: str | None = None
+    if settings.cache_lock_enabled:
+        client = _ensure_client()
+        candidate = uuid4().hex
+        timeout_ms = int(settings.cache_lock_timeout_s * 1000)
+        if await client.set(lock_key, candidate, nx=True, px=timeout_ms):
+            token = candidate
+        elif not wait_for_winner:
+            return None
+        else:
+            deadline = time.monotonic() + settings.cache_lock_timeout_s
+            while time.monotonic() < deadline:
+                await asyncio.sleep(settings.cache_lock_poll_s)
+                value = await getter(key)
+                if value is not None:
+                    return value
+
+    try:
+        value = await compute()
+        await setter(value)
+        return value
+    finally:
+        if token is not None:
+            await _ensure_client().eval(_RELEASE_LOCK_LUA, 1, lock_key, token)
+
+
+def _schedule_refresh(key: str, refresh: Callable[[], Awaitable[Any]]) -> None:
+    """Refresh a stale entry in the background, at most once per key at a time."""
+
+    if key in _refreshing:
+        return
+    _stats["refreshes"] += 1
+    task = asyncio.create_task(refresh())
+    _refreshing[key] = task
+    task.add_done_callback(lambda t: _finish_refresh(key, t))
+
+
+def _finish_refresh(key: str, task: asyncio.Task[Any]) -> None:
+    _refreshing.pop(key, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("background cache refresh for %s failed: %s", key, task.exception())
+
+
+async def _get_or_compute(
+    key: str,
+    ttl: int,
+    stale_ttl: int,
+    compute: Callable[[], Awaitable[T]],
+    decode: Callable[[memoryview], T],
+    encode: Callable[[T], bytes],
+) -> T:
+    async def getter(k: str) -> Optional[T]:
+        hit = await _lookup(k, decode)
+        return hit[0] if hit is not None and hit[1] else None
+
+    async def setter(value: T) -> None:
+        await _store(key, value, encode(value), ttl, stale_ttl)
+
+    async def refresh() -> None:
+        # Another worker may already have refreshed Redis behind our local copy.
+        data, remaining = await _get_redis(key)
+        unpacked = _unpack(data) if data is not None else None
+        if unpacked is not None and unpacked[1] > time.time():
+            payload, fresh_until = unpacked
+            local_cache.set(key, (decode(payload), fresh_until), len(payload), remaining)
+            return
+        await _fill_with_lock(key, compute, getter, setter, wait_for_winner=False)
+
+    hit = await _lookup(key, decode)
+    if hit is not None:
+        value, fresh = hit
+        if not fresh:
+            _stats["stale_served"] += 1
+            _schedule_refresh(key, refresh)
+        return value
+
+    result = await coalesce(key, lambda: _fill_with_lock(key, compute, getter, setter))
+    assert result is not None  # only background refreshes give up on a lost lock
+    return result
+
+
+async def get_or_compute_json(
+    key: str,
+    ttl: int,
+    compute: Callable[[], Awaitable[Any]],
+    stale_ttl: int = 0,
+) -> Any:
+    """Return a cached JSON value, computing it on a miss.
+
+    Entries older than ``ttl`` but younger than ``ttl + stale_ttl`` are served
+    immediately while a deduplicated background task recomputes them.
+    """
+
+    return await _get_or_compute(key, ttl, stale_ttl, compute, orjson.loads, orjson.dumps)
+
+
+async def get_or_compute_bytes(
+    key: str,
+    ttl: int,
+    compute: Callable[[], Awaitable[bytes]],
+    stale_ttl: int = 0,
+) -> bytes:
+    return await _get_or_compute(key, ttl, stale_ttl, compute, _decode_bytes, bytes)
+
+
+def stats() -> dict[str, Any]:
+    """Per-tier hit counters and ratios for this process."""
+
+    lookups = _stats["local_hits"] + _stats["redis_hits"] + _stats["misses"]
+    local_ratio = _stats["local_hits"] / lookups if lookups else 0.0
+    # Redis only sees lookups that missed the local tier.
+    redis_lookups = lookups - _stats["local_hits"]
+    redis_ratio = _stats["redis_hits"] / redis_lookups if redis_lookups else 0.0
+    return {
+        **_stats,
+        "lookups": lookups,
+        "local_hit_ratio": local_ratio,
+        "redis_hit_ratio": redis_ratio,
+        "local_entries": len(local_cache),
+        "local_bytes": local_cache.size,
+        "local_max_bytes": local_cache.max_bytes,
+        "inflight": len(_inflight),
+    }
 
 
 async def ping() -> bool:
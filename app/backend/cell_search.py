@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import math
+from typing import Any
+from uuid import UUID
+
+import numpy as np
+
+import cache
+import dataset
+import geo
+import tiles
+from db import Database
+from geometry import Geometry
+from queries import CELL_AMENITIES_SQL
+
+# Amenities are cached per zoom-14 tile (roughly 1-2 km across), independent
+# of radius and category, so overlapping routes share the same cell entries.
+CELL_ZOOM = 14
+CELL_CACHE_TTL = 60 * 60 * 24
+
+
+def _cell_key(x: int, y: int) -> str:
+    version = dataset.current_version(dataset.AMENITIES)
+    generation = dataset.tile_generation(CELL_ZOOM, x, y)
+    return f"cell:v2:{version}:{generation}:{CELL_ZOOM}/{x}/{y}"
+
+
+def covering_cells(coordinates: list[list[float]], radius_m: float) -> list[tuple[int, int]]:
+    """Return the cells that can hold an amenity within ``radius_m`` of the line."""
+
+    top = max(abs(coord[1]) for coord in coordinates)
+    ring = max(1, math.ceil(radius_m / tiles.tile_size_m(CELL_ZOOM, top)))
+    n = 1 << CELL_ZOOM
+    cells: set[tuple[int, int]] = set()
+    for cx, cy in tiles.cells_along_line(coordinates, CELL_ZOOM):
+        for x in range(max(0, cx - ring), min(n, cx + ring + 1)):
+            for y in range(max(0, cy - ring), min(n, cy + ring + 1)):
+                cells.add((x, y))
+    return sorted(cells)
+
+
+async def load_cells(db: Database, cells: list[tuple[int, int]]) -> list[list[Any]]:
+    """Return ``[id, category, props, lon, lat]`` entries for the given cells.
+
+    Cached cells come from one MGET; the rest are read with one query and
+    cached under the current dataset version and tile generation.
+    """
+
+    keys = [_cell_key(x, y) for x, y in cells]
+    entries: list[list[Any]] = []
+    missing: dict[tuple[int, int], str] = {}
+    for cell, key, hit in zip(cells, keys, await cache.get_many_json(keys)):
+        if hit is None:
+            missing[cell] = key
+        else:
+            entries.extend(hit)
+    if not missing:
+        return entries
+
+    loaded: dict[tuple[int, int], list[list[Any]]] = {cell: [] for cell in missing}
+    rows = await db.fetch(
+        CELL_AMENITIES_SQL, CELL_ZOOM, [x for x, _ in missing], [y for _, y in missing]
+    )
+    for row in rows:
+        loaded[(row["x"], row["y"])].append(
+            [str(row["id"]), row["category"], row["props"], row["lon"], row["lat"]]
+        )
+    await cache.set_many_json({missing[cell]: value for cell, value in loaded.items()}, CELL_CACHE_TTL)
+    for value in loaded.values():
+        entries.extend(value)
+    return entries
+
+
+async def search_cells(
+    db: Database,
+    route: dict[str, Any],
+    radius_m: float,
+    categories: list[str] | None,
+    order: str,
+    after: tuple[float, UUID] | None,
+    limit: int | None,
+) -> list[dict[str, Any]]:
+    """Search a route by assembling cached cell contents and refining exact
+    distances in process. Rows have the same fields as the SQL engines.
+    """
+
+    coordinates = route["geometry"]["coordinates"]
+    wanted = set(categories) if categories else None
+    candidates: dict[str, list[Any]] = {}
+    for entry in await load_cells(db, covering_cells(coordinates, radius_m)):
+        if wanted is None or entry[1] in wanted:
+            candidates.setdefault(entry[0], entry)
+    entries = list(candidates.values())
+    lons = np.array([entry[3] for entry in entries], dtype=np.float64)
+    lats = np.array([entry[4] for entry in entries], dtype=np.float64)
+    dists, alongs = geo.locate(lons, lats, geo.as_line(coordinates), radius_m)
+    rows: list[dict[str, Any]] = []
+    for (amenity_id, category, props, lon, lat), dist_m, along_m in zip(entries, dists.tolist(), alongs.tolist()):
+        if dist_m > radius_m:
+            continue
+        rows.append(
+            {
+                "id": UUID(amenity_id),
+                "category": category,
+                "props": props,
+                "dist_m": dist_m,
+                "along_m": along_m,
+                "geom": Geometry.point(lon, lat),
+            }
+        )
+
+    def sort_key(row: dict[str, Any]) -> tuple[float, UUID]:
+        return (row["along_m"] if order == "along" else row["dist_m"], row["id"])
+
+    if after is not None:
+        rows = [row for row in rows if sort_key(row) > after]
+    rows.sort(key=sort_key)
+    return rows if limit is None else rows[:limit]
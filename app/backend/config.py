@@ -11,6 +11,30 @@ class Settings(BaseSettings):
     frontend_port: int = 5173
     tileserver_port: int = 7800
     gpx_output_dir: str = "out"
+    # Pre-rendered amenities tiles; an empty path disables the archive.
+    mvt_archive_path: str = "tiles/amenities.mbtiles"
+    # Tiles per side rendered together on a cache miss (power of two; 1 disables).
+    mvt_metatile_size: int = 4
+    # Upper bound on tiles a single /tiles/pyramid job may render.
+    mvt_pyramid_max_tiles: int = 2_000_000
+    local_cache_max_bytes: int = 64 * 1024 * 1024
+    cache_lock_enabled: bool = True
+    cache_lock_timeout_s: float = 10.0
+    cache_lock_poll_s: float = 0.05
+    dataset_version_poll_s: float = 30.0
+    # Must exceed the longest cache TTL plus its stale window.
+    change_log_retention_s: int = 60 * 60 * 48
+    corridor_precompute_radii: list[int] = [250, 500, 1000]
+    search_engine: str = "corridor"
+    route_index_radius_m: float = 2000.0
+    search_segment_min_route_m: float = 50_000.0
+    search_segment_length_m: float = 25_000.0
+    search_segment_concurrency: int = 4
+    search_batch_max_requests: int = 100
+    search_batch_concurrency: int = 8
+    # POST /routes bodies larger than this are rejected with 413 before
+    # they are parsed (see UploadLimitMiddleware).
+    max_upload_bytes: int = 50 * 1024 * 1024
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore")
 
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+from typing import Any, Iterable, Optional
+
+import tiles
+from config import settings
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+AMENITIES = "amenities"
+VERSION_CHANNEL = "dataset_version"
+CHANGES_CHANNEL = "amenity_changes"
+VERSIONS_SQL = "SELECT name, version FROM dataset_versions"
+CHANGES_SQL = """
+SELECT change_id, ST_X(geom) AS lon, ST_Y(geom) AS lat
+FROM amenity_changes
+WHERE change_id > $1
+  AND changed_at > NOW() - make_interval(secs => $2)
+ORDER BY change_id
+"""
+PRUNE_CHANGES_SQL = "DELETE FROM amenity_changes WHERE changed_at < NOW() - make_interval(secs => $1)"
+# First change id still tracked: the oldest one inside the retention window,
+# or the next id to be issued when the window is empty.
+OLDEST_CHANGE_SQL = """
+SELECT COALESCE(
+    (SELECT min(change_id) FROM amenity_changes WHERE changed_at > NOW() - make_interval(secs => $1)),
+    pg_sequence_last_value(pg_get_serial_sequence('amenity_changes', 'change_id')) + 1,
+    1
+)
+"""
+
+# Tile generations are tracked per tile up to this zoom; deeper tiles use
+# their ancestor at this zoom, which is conservative but still local.
+MAX_TRACKED_TILE_ZOOM = 16
+# Search regions are tracked on a coarse tile grid (~20-40 km cells).
+REGION_CELL_ZOOM = 10
+# Sequence values are handed out before commit, so a change can become
+# visible after a higher id; re-reading a short tail of ids catches those.
+CHANGE_RESCAN_IDS = 256
+
+# Versions and generations only ever increase. Cache keys embed them, so a
+# change makes derived entries unreachable without deleting anything. The
+# values are change ids from PostgreSQL, so every process computes the same
+# keys for the same data.
+_versions: dict[str, int] = {}
+_tile_gens: dict[tuple[int, int, int], int] = {}
+_cell_gens: dict[tuple[int, int], int] = {}
+_last_change_id = 0
+# Generations below this change id have been pruned from _tile_gens.
+_tracked_since = 0
+_changes_lock = asyncio.Lock()
+_poller: Optional[asyncio.Task[None]] = None
+_pending: set[asyncio.Task[None]] = set()
+
+
+def current_version(name: str) -> int:
+    return _versions.get(name, 0)
+
+
+def tile_generation(z: int, x: int, y: int) -> int:
+    """Return the id of the latest amenity change inside the given tile."""
+
+    if not _tile_gens:
+        return 0
+    if z > MAX_TRACKED_TILE_ZOOM:
+        shift = z - MAX_TRACKED_TILE_ZOOM
+        z, x, y = MAX_TRACKED_TILE_ZOOM, x >> shift, y >> shift
+    return _tile_gens.get((z, x, y), 0)
+
+
+def last_change_id() -> int:
+    return _last_change_id
+
+
+def tracked_since() -> int:
+    """Changes with an id at or below this may have been forgotten."""
+
+    return _tracked_since
+
+
+def changed_tiles(z: int, since: int) -> Optional[list[tuple[int, int]]]:
+    """Return the zoom-``z`` tiles changed after change id ``since``.
+
+    Returns None when that history has already been pruned, in which case the
+    caller has to reload everything. Ids within CHANGE_RESCAN_IDS of ``since``
+    are included because they may have become visible after it.
+    """
+
+    if z > MAX_TRACKED_TILE_ZOOM:
+        raise ValueError(f"tiles are tracked up to zoom {MAX_TRACKED_TILE_ZOOM}")
+    if since < _tracked_since:
+        return None
+    floor = since - CHANGE_RESCAN_IDS
+    return [(x, y) for (tz, x, y), gen in _tile_gens.items() if tz == z and gen > floor]
+
+
+def region_generation(cells: Iterable[Iterable[int]], radius_m: float, lat: float) -> int:
+    """Return the latest change id within ``radius_m`` of the given region cells.
+
+    ``cells`` are the REGION_CELL_ZOOM tiles touched by a route; the radius is
+    covered by widening each cell by whole neighbouring cells.
+    """
+
+    if not _cell_gens:
+        return 0
+    ring = max(1, math.ceil(radius_m / tiles.tile_size_m(REGION_CELL_ZOOM, lat)))
+    latest = 0
+    for cx, cy in cells:
+        for dx in range(-ring, ring + 1):
+            for dy in range(-ring, ring + 1):
+                gen = _cell_gens.get((cx + dx, cy + dy))
+                if gen is not None and gen > latest:
+                    latest = gen
+    return latest
+
+
+def _apply_version(name: str, version: int) -> None:
+    if version > _versions.get(name, 0):
+        _versions[name] = version
+
+
+def _apply_change(change_id: int, lon: float, lat: float) -> None:
+    for z in range(MAX_TRACKED_TILE_ZOOM + 1):
+        for x, y in tiles.tiles_for_point(lon, lat, z):
+            if change_id > _tile_gens.get((z, x, y), 0):
+                _tile_gens[(z, x, y)] = change_id
+    for x, y in tiles.tiles_for_point(lon, lat, REGION_CELL_ZOOM):
+        if change_id > _cell_gens.get((x, y), 0):
+            _cell_gens[(x, y)] = change_id
+
+
+def _on_version_notify(payload: str) -> None:
+    name, _, version = payload.rpartition(":")
+    try:
+        _apply_version(name, int(version))
+    except ValueError:
+        logger.warning("ignoring malformed dataset version payload %r", payload)
+
+
+async def refresh_versions(db: Database) -> None:
+    for row in await db.fetch(VERSIONS_SQL):
+        _apply_version(row["name"], row["version"])
+
+
+async def refresh_changes(db: Database) -> None:
+    global _last_change_id
+    async with _changes_lock:
+        since = max(_last_change_id - CHANGE_RESCAN_IDS, 0)
+        rows = await db.fetch(CHANGES_SQL, since, settings.change_log_retention_s)
+        for row in rows:
+            _apply_change(row["change_id"], row["lon"], row["lat"])
+            _last_change_id = max(_last_change_id, row["change_id"])
+
+
+def _on_changes_notify(db: Database) -> Any:
+    def callback(_payload: str) -> None:
+        task = asyncio.create_task(refresh_changes(db))
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+
+    return callback
+
+
+async def _prune(db: Database) -> None:
+    # Entries older than the retention window have outlived every cache TTL,
+    # so forgetting their generations cannot resurrect a stale key.
+    global _tracked_since
+    threshold = await db.fetchval(OLDEST_CHANGE_SQL, settings.change_log_retention_s)
+    _tracked_since = max(_tracked_since, threshold - 1)
+    for gens in (_tile_gens, _cell_gens):
+        for key in [key for key, gen in gens.items() if gen < threshold]:
+            del gens[key]
+    await db.execute(PRUNE_CHANGES_SQL, settings.change_log_retention_s)
+
+
+async def _poll(db: Database) -> None:
+    # Safety net for notifications lost while the listener connection was down.
+    while True:
+        await asyncio.sleep(settings.dataset_version_poll_s)
+        try:
+            await refresh_versions(db)
+            await refresh_changes(db)
+            await _prune(db)
+        except Exception as exc:  # pragma: no cover - best effort refresh
+            logger.warning("dataset version poll failed: %s", exc)
+
+
+async def init_versions(db: Database) -> None:
+    global _poller
+    await refresh_versions(db)
+    await refresh_changes(db)
+    # Only the retention window was loaded; mark older history as forgotten.
+    await _prune(db)
+    await db.listen(VERSION_CHANNEL, _on_version_notify)
+    await db.listen(CHANGES_CHANNEL, _on_changes_notify(db))
+    if _poller is None:
+        _poller = asyncio.create_task(_poll(db))
+
+
+async def close_versions() -> None:
+    global _poller
+    if _poller is not None:
+        _poller.cancel()
+        _poller = None
@@ -1,16 +1,38 @@
 from __future__ import annotations
 
 import asyncio
-from typing import Any, Iterable, Optional
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
 
 import asyncpg
+import orjson
 
 from config import settings
+from geometry import decode_ewkb, encode_ewkb
+
+
+def _encode_json(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """Register the binary EWKB geometry codec and a jsonb codec on a connection.
+
+    Geometry columns then decode to geometry.Geometry and jsonb to Python
+    objects; pass Geometry instances for geometry parameters.
+    """
+
+    await conn.set_type_codec(
+        "geometry", schema="public", encoder=encode_ewkb, decoder=decode_ewkb, format="binary"
+    )
+    await conn.set_type_codec(
+        "jsonb", schema="pg_catalog", encoder=_encode_json, decoder=orjson.loads, format="text"
+    )
 
 
 class Database:
     def __init__(self) -> None:
         self._pool: Optional[asyncpg.Pool] = None
+        self._listener: Optional[asyncpg.Connection] = None
 
     async def init_pool(self) -> None:
         if self._pool is None:
@@ -21,9 +43,13 @@ class Database:
                 password=settings.postgres_password,
                 min_size=1,
                 max_size=10,
+                init=init_connection,
             )
 
     async def close(self) -> None:
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
         if self._pool is not None:
             await self._pool.close()
             self._pool = None
@@ -53,6 +79,27 @@ class Database:
         async with pool.acquire() as conn:
             return await conn.execute(query, *args)
 
+    async def iterate(self, query: str, *args: Any, prefetch: int = 200) -> AsyncIterator[asyncpg.Record]:
+        """Stream rows through a server-side cursor, holding one connection throughout."""
+
+        pool = self._ensure_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                async for record in conn.cursor(query, *args, prefetch=prefetch):
+                    yield record
+
+    async def listen(self, channel: str, callback: Callable[[str], None]) -> None:
+        """Subscribe to a NOTIFY channel on a dedicated connection outside the pool."""
+
+        if self._listener is None:
+            self._listener = await asyncpg.connect(
+                host=settings.postgres_host,
+                database=settings.postgres_db,
+                user=settings.postgres_user,
+                password=settings.postgres_password,
+            )
+        await self._listener.add_listener(channel, lambda _conn, _pid, _channel, payload: callback(payload))
+
 
 # Singleton database instance used by the FastAPI app
 _database = Database()
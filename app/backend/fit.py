@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import struct
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import geo
+
+FIT_SIGNATURE = b".FIT"
+FIT_EPOCH = 631065600  # 1989-12-31T00:00:00Z as a Unix timestamp
+FIT_PROTOCOL_VERSION = 0x10
+FIT_PROFILE_VERSION = 2100
+# Global message numbers and the fields read from them.
+MESG_FILE_ID = 0
+MESG_LAP = 19
+MESG_RECORD = 20
+MESG_EVENT = 21
+MESG_COURSE = 31
+MESG_COURSE_POINT = 32
+RECORD_POSITION_LAT = 0
+RECORD_POSITION_LONG = 1
+COURSE_NAME = 5
+
+SEMICIRCLES_TO_DEGREES = 180.0 / 2**31
+_INVALID_SINT32 = 0x7FFFFFFF
+_CRC_SIZE = 2
+
+
+class FITParseError(ValueError):
+    """Raised when an uploaded FIT file cannot be decoded."""
+
+
+class FITBuildError(Exception):
+    """Raised when FIT output cannot be produced."""
+
+
+def is_fit(head: bytes) -> bool:
+    return len(head) >= 12 and head[8:12] == FIT_SIGNATURE
+
+
+class _Definition:
+    """A local message definition compiled to one struct for its data messages."""
+
+    __slots__ = ("global_num", "size", "unpack", "lat", "lon", "name")
+
+    def __init__(self, global_num: int, little: bool, fields: list[tuple[int, int]], dev_size: int) -> None:
+        self.global_num = global_num
+        self.lat = self.lon = self.name = None
+        fmt = ["<" if little else ">"]
+        slot = 0
+        for num, size in fields:
+            if global_num == MESG_RECORD and num in (RECORD_POSITION_LAT, RECORD_POSITION_LONG) and size == 4:
+                fmt.append("i")
+                if num == RECORD_POSITION_LAT:
+                    self.lat = slot
+                else:
+                    self.lon = slot
+                slot += 1
+            elif global_num == MESG_COURSE and num == COURSE_NAME:
+                fmt.append(f"{size}s")
+                self.name = slot
+                slot += 1
+            else:
+                fmt.append(f"{size}x")
+        if dev_size:
+            fmt.append(f"{dev_size}x")
+        compiled = struct.Struct("".join(fmt))
+        self.size = compiled.size
+        self.unpack = compiled.unpack_from
+
+
+class FITTrackReader:
+    """Incrementally decode FIT bytes fed in chunks into record positions.
+
+    Same interface as gpx.GPXTrackReader: ``record`` message positions are
+    converted from semicircles and appended to a flat ``array('d')`` of
+    lon/lat, and a course name is kept if present. Each local message
+    definition is compiled once to a struct that unpacks only the position
+    fields; all other messages are skipped by size. Chained FIT files are
+    read back to back. CRCs are not verified.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._remaining: Optional[int] = None  # data bytes left in the current file
+        self._definitions: dict[int, _Definition] = {}
+        self.name: Optional[str] = None
+        self.coords = array("d")
+
+    def feed(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        consumed = self._parse()
+        del self._buffer[:consumed]
+
+    def close(self) -> tuple[Optional[str], array]:
+        """Finish decoding and return ``(name, coords)``."""
+
+        if self._remaining is not None or self._buffer:
+            raise FITParseError("Truncated FIT file")
+        return self.name, self.coords
+
+    def _parse(self) -> int:
+        buf = self._buffer
+        pos = 0
+        end = len(buf)
+        coords = self.coords
+        definitions = self._definitions
+        while True:
+            if self._remaining is None:
+                if end - pos < 12:
+                    return pos
+                header_size = buf[pos]
+                if header_size < 12 or buf[pos + 8 : pos + 12] != FIT_SIGNATURE:
+                    raise FITParseError("Not a FIT file")
+                if end - pos < header_size:
+                    return pos
+                (self._remaining,) = struct.unpack_from("<I", buf, pos + 4)
+                definitions.clear()
+                pos += header_size
+                continue
+
+            if self._remaining == 0:
+                if end - pos < _CRC_SIZE:
+                    return pos
+                pos += _CRC_SIZE
+                self._remaining = None
+                continue
+
+            if pos >= end:
+                return pos
+            header = buf[pos]
+            if header & 0x80:
+                # Compressed timestamp header: always a data message.
+                local, is_definition = (header >> 5) & 0x03, False
+            else:
+                local, is_definition = header & 0x0F, bool(header & 0x40)
+
+            if is_definition:
+                if end - pos < 6:
+                    return pos
+                little = buf[pos + 2] == 0
+                global_num = struct.unpack_from("<H" if little else ">H", buf, pos + 3)[0]
+                count = buf[pos + 5]
+                size = 6 + 3 * count
+                has_dev = bool(header & 0x20)
+                if end - pos < size + has_dev:
+                    return pos
+                fields = [(buf[pos + 6 + 3 * i], buf[pos + 7 + 3 * i]) for i in range(count)]
+                dev_size = 0
+                if has_dev:
+                    dev_count = buf[pos + size]
+                    size += 1 + 3 * dev_count
+                    if end - pos < size:
+                        return pos
+                    dev_size = sum(buf[pos + size - 3 * dev_count + 3 * i + 1] for i in range(dev_count))
+                definitions[local] = _Definition(global_num, little, fields, dev_size)
+            else:
+                definition = definitions.get(local)
+                if definition is None:
+                    raise FITParseError(f"Data message for undefined local type {local}")
+                size = 1 + definition.size
+                if end - pos < size:
+                    return pos
+                if definition.lat is not None and definition.lon is not None:
+                    values = definition.unpack(buf, pos + 1)
+                    lat, lon = values[definition.lat], values[definition.lon]
+                    if lat != _INVALID_SINT32 and lon != _INVALID_SINT32:
+                        coords.append(lon * SEMICIRCLES_TO_DEGREES)
+                        coords.append(lat * SEMICIRCLES_TO_DEGREES)
+                elif definition.name is not None and self.name is None:
+                    raw = definition.unpack(buf, pos + 1)[definition.name]
+                    self.name = raw.split(b"\0", 1)[0].decode("utf-8", "replace") or None
+
+            if size > self._remaining:
+                raise FITParseError("FIT message overruns the data section")
+            self._remaining -= size
+            pos += size
+
+
+# Course export. Records get timestamps from a constant virtual speed so
+# devices can show progress and virtual partner pacing.
+COURSE_SPEED_MPS = 5.0
+FILE_TYPE_COURSE = 6
+MANUFACTURER_DEVELOPMENT = 255
+SPORT_CYCLING = 2
+EVENT_TIMER = 0
+EVENT_TYPE_START = 0
+EVENT_TYPE_STOP_DISABLE_ALL = 9
+FIT_WRITE_CHUNK = 64 * 1024
+# Amenity category -> FIT course_point type; anything else is "generic".
+COURSE_POINT_TYPES = {
+    "toilet": 39,
+    "toilets": 39,
+    "water": 3,
+    "drinking_water": 3,
+    "cafe": 4,
+    "restaurant": 4,
+    "fast_food": 4,
+    "viewpoint": 38,
+    "bench": 29,
+    "shelter": 36,
+    "pharmacy": 9,
+    "first_aid": 9,
+}
+COURSE_POINT_GENERIC = 0
+
+_CRC_TABLE = []
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = (_crc >> 1) ^ 0xA001 if _crc & 1 else _crc >> 1
+    _CRC_TABLE.append(_crc)
+
+
+def fit_crc(data: bytes, crc: int = 0) -> int:
+    """The FIT CRC-16 (CRC-16/ARC) of ``data``, continuing from ``crc``."""
+
+    table = _CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _Message:
+    """A local message type: its definition record and a struct for its data records."""
+
+    def __init__(self, local: int, global_num: int, fields: list[tuple[int, int, int, str]]) -> None:
+        self.local = local
+        self.definition = struct.pack("<BBBHB", 0x40 | local, 0, 0, global_num, len(fields)) + b"".join(
+            struct.pack("<BBB", num, size, base_type) for num, size, base_type, _ in fields
+        )
+        self.data = struct.Struct("<B" + "".join(fmt for *_, fmt in fields))
+
+    def pack(self, *values: Any) -> bytes:
+        return self.data.pack(self.local, *values)
+
+    def size(self, count: int) -> int:
+        return len(self.definition) + self.data.size * count if count else 0
+
+
+# (field number, size, base type, struct format)
+_FILE_ID = _Message(0, MESG_FILE_ID, [(0, 1, 0x00, "B"), (1, 2, 0x84, "H"), (2, 2, 0x84, "H"), (3, 4, 0x8C, "I"), (4, 4, 0x86, "I")])
+_COURSE = _Message(1, MESG_COURSE, [(4, 1, 0x00, "B"), (COURSE_NAME, 32, 0x07, "32s")])
+_LAP = _Message(
+    2,
+    MESG_LAP,
+    [(253, 4, 0x86, "I"), (2, 4, 0x86, "I")]
+    + [(num, 4, 0x85, "i") for num in (3, 4, 5, 6)]
+    + [(num, 4, 0x86, "I") for num in (7, 8, 9)],
+)
+_EVENT = _Message(3, MESG_EVENT, [(253, 4, 0x86, "I"), (0, 1, 0x00, "B"), (1, 1, 0x00, "B"), (4, 1, 0x02, "B")])
+_RECORD = _Message(
+    4,
+    MESG_RECORD,
+    [(253, 4, 0x86, "I"), (RECORD_POSITION_LAT, 4, 0x85, "i"), (RECORD_POSITION_LONG, 4, 0x85, "i"), (5, 4, 0x86, "I")],
+)
+_COURSE_POINT = _Message(
+    5,
+    MESG_COURSE_POINT,
+    [(254, 2, 0x84, "H"), (1, 4, 0x86, "I"), (2, 4, 0x85, "i"), (3, 4, 0x85, "i"), (4, 4, 0x86, "I"), (5, 1, 0x00, "B"), (6, 16, 0x07, "16s")],
+)
+
+
+def _semicircles(degrees: float) -> int:
+    # +180 degrees would overflow sint32 (and 0x7FFFFFFF means invalid).
+    return min(round(degrees / SEMICIRCLES_TO_DEGREES), _INVALID_SINT32 - 1)
+
+
+def _fit_string(text: str, size: int) -> bytes:
+    # Leave room for the terminator without splitting a UTF-8 sequence.
+    return text.encode("utf-8")[: size - 1].decode("utf-8", "ignore").encode("utf-8")
+
+
+def _course_points(pois: Iterable[dict], line: Any) -> list[tuple[float, float, float, int, str]]:
+    points = []
+    for poi in pois:
+        coords = (poi.get("geometry") or {}).get("coordinates")
+        if not coords:
+            continue
+        category = poi.get("category", "POI")
+        label = (poi.get("props") or {}).get("name") or category
+        points.append((coords[0], coords[1], COURSE_POINT_TYPES.get(category, COURSE_POINT_GENERIC), label))
+    if not points:
+        return []
+    _, alongs = geo.locate([p[0] for p in points], [p[1] for p in points], line)
+    return sorted(
+        ((along, lon, lat, kind, label) for (lon, lat, kind, label), along in zip(points, alongs.tolist())),
+        key=lambda point: point[0],
+    )
+
+
+def build_fit(
+    route: dict,
+    pois: Iterable[dict],
+    output_file: Path,
+) -> Path:
+    """Create a FIT course file with records for the route and course points for amenities.
+
+    Every message has a fixed size, so the header (with the data size) is
+    written first and the records are streamed to disk in chunks while the
+    file CRC is accumulated.
+    """
+
+    if len(route.get("coordinates") or []) < 2:
+        raise FITBuildError("Route data must include at least two coordinates")
+
+    line = geo.as_line(route["coordinates"])
+    alongs = geo.vertex_distances(line).tolist()
+    points = _course_points(pois, line)
+    total_m = alongs[-1]
+    start = int(time.time()) - FIT_EPOCH
+    end = start + int(total_m / COURSE_SPEED_MPS)
+    start_lat, start_lon = _semicircles(line[0, 1]), _semicircles(line[0, 0])
+    end_lat, end_lon = _semicircles(line[-1, 1]), _semicircles(line[-1, 0])
+
+    data_size = (
+        _FILE_ID.size(1) + _COURSE.size(1) + _LAP.size(1) + _EVENT.size(2)
+        + _RECORD.size(len(alongs)) + _COURSE_POINT.size(len(points))
+    )
+    header = struct.pack("<BBHI4s", 14, FIT_PROTOCOL_VERSION, FIT_PROFILE_VERSION, data_size, FIT_SIGNATURE)
+    header += struct.pack("<H", fit_crc(header))
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with output_file.open("wb") as fh:
+        crc = 0
+        chunk = bytearray(header)
+
+        def flush() -> None:
+            nonlocal crc
+            crc = fit_crc(chunk, crc)
+            fh.write(chunk)
+            chunk.clear()
+
+        chunk += _FILE_ID.definition
+        chunk += _FILE_ID.pack(FILE_TYPE_COURSE, MANUFACTURER_DEVELOPMENT, 0, 1, start)
+        chunk += _COURSE.definition
+        chunk += _COURSE.pack(SPORT_CYCLING, _fit_string(route.get("name") or "Route", 32))
+        elapsed_ms = (end - start) * 1000
+        chunk += _LAP.definition
+        chunk += _LAP.pack(end, start, start_lat, start_lon, end_lat, end_lon, elapsed_ms, elapsed_ms, round(total_m * 100))
+        chunk += _EVENT.definition
+        chunk += _EVENT.pack(start, EVENT_TIMER, EVENT_TYPE_START, 0)
+
+        chunk += _RECORD.definition
+        pack_record = _RECORD.pack
+        for (lon, lat), along in zip(line.tolist(), alongs):
+            chunk += pack_record(
+                start + int(along / COURSE_SPEED_MPS), _semicircles(lat), _semicircles(lon), round(along * 100)
+            )
+            if len(chunk) >= FIT_WRITE_CHUNK:
+                flush()
+
+        if points:
+            chunk += _COURSE_POINT.definition
+        for index, (along, lon, lat, kind, label) in enumerate(points):
+            chunk += _COURSE_POINT.pack(
+                index,
+                start + int(along / COURSE_SPEED_MPS),
+                _semicircles(lat),
+                _semicircles(lon),
+                round(along * 100),
+                kind,
+                _fit_string(label, 16),
+            )
+
+        chunk += _EVENT.pack(end, EVENT_TIMER, EVENT_TYPE_STOP_DISABLE_ALL, 0)
+        flush()
+        fh.write(struct.pack("<H", crc))
+
+    return output_file
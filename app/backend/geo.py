@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import math
+from typing import Any
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_M * math.pi / 180.0
+# Point x segment pairs evaluated per batch (bounds peak memory).
+DISTANCE_BATCH = 1 << 20
+# Upper bound on segment pieces in the locate() grid; beyond it cells grow.
+GRID_MAX_PIECES = 1 << 18
+# Grid cells with at least this many points are searched on their own.
+GRID_CROWDED_CELL = 32
+
+
+def as_line(coordinates: Any) -> np.ndarray:
+    """Return a ``(n, 2)`` float array of lon/lat from GeoJSON-style coordinates."""
+
+    line = np.asarray([coord[:2] for coord in coordinates], dtype=np.float64)
+    if len(line) < 2:
+        raise ValueError("A polyline needs at least two points")
+    return line
+
+
+def _segments(line: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Per-segment length in metres and distance of its start along the line."""
+
+    x0, y0, x1, y1 = line[:-1, 0], line[:-1, 1], line[1:, 0], line[1:, 1]
+    mid_kx = METERS_PER_DEGREE * np.cos(np.radians((y0 + y1) / 2))
+    seg_len = np.hypot((x1 - x0) * mid_kx, (y1 - y0) * METERS_PER_DEGREE)
+    seg_start = np.concatenate(([0.0], np.cumsum(seg_len)[:-1]))
+    return seg_len, seg_start
+
+
+def vertex_distances(line: np.ndarray) -> np.ndarray:
+    """Distance (m) of each vertex of a lon/lat polyline from its start."""
+
+    seg_len, seg_start = _segments(line)
+    return np.append(seg_start, seg_start[-1] + seg_len[-1])
+
+
+def _nearest(
+    lon: np.ndarray,
+    lat: np.ndarray,
+    line: np.ndarray,
+    segs: np.ndarray,
+    seg_len: np.ndarray,
+    seg_start: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    x0, y0 = line[segs, 0], line[segs, 1]
+    x1, y1 = line[segs + 1, 0], line[segs + 1, 1]
+    dist = np.empty(len(lon))
+    along = np.empty(len(lon))
+    step = max(1, DISTANCE_BATCH // len(segs))
+    for start in range(0, len(lon), step):
+        plon = lon[start : start + step, None]
+        plat = lat[start : start + step, None]
+        # Equirectangular projection centred on each point.
+        kx = METERS_PER_DEGREE * np.cos(np.radians(plat))
+        ax = (x0 - plon) * kx
+        ay = (y0 - plat) * METERS_PER_DEGREE
+        dx = (x1 - x0) * kx
+        dy = np.broadcast_to((y1 - y0) * METERS_PER_DEGREE, dx.shape)
+        length_sq = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(length_sq > 0, length_sq, 1.0), 0.0, 1.0)
+        d = np.hypot(ax + t * dx, ay + t * dy)
+        best = np.argmin(d, axis=1)
+        rows = np.arange(len(best))
+        nearest = segs[best]
+        dist[start : start + step] = d[rows, best]
+        along[start : start + step] = seg_start[nearest] + t[rows, best] * seg_len[nearest]
+    return dist, along
+
+
+def _nearest_candidates(
+    lon: np.ndarray,
+    lat: np.ndarray,
+    line: np.ndarray,
+    entry_segs: np.ndarray,
+    first: np.ndarray,
+    counts: np.ndarray,
+    seg_len: np.ndarray,
+    seg_start: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Like _nearest, but point ``i`` is only compared with
+    ``entry_segs[first[i] : first[i] + counts[i]]``; points without candidates
+    report ``inf``.
+    """
+
+    dist = np.full(len(lon), np.inf)
+    along = np.zeros(len(lon))
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(lon):
+        # Take points until the batch holds DISTANCE_BATCH point x segment pairs.
+        base = ends[start - 1] if start else 0
+        stop = max(int(np.searchsorted(ends, base + DISTANCE_BATCH, side="right")), start + 1)
+        n = counts[start:stop]
+        point = np.repeat(np.arange(start, stop), n)
+        offset = np.arange(len(point)) - np.repeat(np.cumsum(n) - n, n)
+        segs = entry_segs[np.repeat(first[start:stop], n) + offset]
+        start = stop
+        if not len(point):
+            continue
+        plon, plat = lon[point], lat[point]
+        x0, y0 = line[segs, 0], line[segs, 1]
+        kx = METERS_PER_DEGREE * np.cos(np.radians(plat))
+        ax = (x0 - plon) * kx
+        ay = (y0 - plat) * METERS_PER_DEGREE
+        dx = (line[segs + 1, 0] - x0) * kx
+        dy = (line[segs + 1, 1] - y0) * METERS_PER_DEGREE
+        length_sq = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(length_sq > 0, length_sq, 1.0), 0.0, 1.0)
+        d = np.hypot(ax + t * dx, ay + t * dy)
+        # Pairs are grouped by point with segments ascending, so the first
+        # minimum in each group is the one argmin would pick.
+        n = n[n > 0]
+        hits = np.flatnonzero(d == np.repeat(np.minimum.reduceat(d, np.cumsum(n) - n), n))
+        best = hits[np.unique(point[hits], return_index=True)[1]]
+        dist[point[best]] = d[best]
+        along[point[best]] = seg_start[segs[best]] + t[best] * seg_len[segs[best]]
+    return dist, along
+
+
+def locate(
+    lon: np.ndarray,
+    lat: np.ndarray,
+    line: np.ndarray,
+    max_distance_m: float | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the distance (m) from each point to a lon/lat polyline and the
+    point's position along it (m from the start).
+
+    Each point is projected equirectangularly around itself, which stays
+    within a fraction of a percent of the geodesic distance at corridor
+    scale. With ``max_distance_m`` segments are bucketed on a grid of that
+    size and each point is only compared with segments in its cell; points
+    farther than ``max_distance_m`` may then report ``inf``.
+    """
+
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    seg_len, seg_start = _segments(line)
+    if max_distance_m is None or not len(lon):
+        return _nearest(lon, lat, line, np.arange(len(seg_len)), seg_len, seg_start)
+
+    # Size cells for the highest latitude a matching point can have, where a
+    # degree of longitude is shortest. Segments are cut into pieces no longer
+    # than a cell and each piece is registered in the cells of its bounding
+    # box widened by one cell, so cost follows segment length rather than
+    # bounding-box area.
+    reach = max(max_distance_m / METERS_PER_DEGREE, 1e-9)
+    top = min(float(np.abs(line[:, 1]).max()) + reach, 89.0)
+    cell_lon = reach / math.cos(math.radians(top))
+    cell_lat = reach
+    dx = line[1:, 0] - line[:-1, 0]
+    dy = line[1:, 1] - line[:-1, 1]
+    pieces = float(np.maximum(np.abs(dx) / cell_lon, np.abs(dy) / cell_lat).sum())
+    if len(lon) * len(seg_len) <= pieces:
+        # Fewer pairs than the grid would hold: comparing everything is cheaper.
+        return _nearest(lon, lat, line, np.arange(len(seg_len)), seg_len, seg_start)
+    if pieces > GRID_MAX_PIECES:
+        # Larger cells stay correct; they only admit more candidate segments.
+        cell_lon *= pieces / GRID_MAX_PIECES
+        cell_lat *= pieces / GRID_MAX_PIECES
+    steps = np.maximum(np.ceil(np.maximum(np.abs(dx) / cell_lon, np.abs(dy) / cell_lat)), 1).astype(np.int64)
+    seg = np.repeat(np.arange(len(steps)), steps)
+    per_seg = np.repeat(steps, steps)
+    k = np.arange(len(seg)) - np.repeat(np.cumsum(steps) - steps, steps)
+    xa = line[seg, 0] + k / per_seg * dx[seg]
+    xb = line[seg, 0] + (k + 1) / per_seg * dx[seg]
+    ya = line[seg, 1] + k / per_seg * dy[seg]
+    yb = line[seg, 1] + (k + 1) / per_seg * dy[seg]
+    gx0 = np.floor(np.minimum(xa, xb) / cell_lon).astype(np.int64) - 1
+    gx1 = np.floor(np.maximum(xa, xb) / cell_lon).astype(np.int64) + 1
+    gy0 = np.floor(np.minimum(ya, yb) / cell_lat).astype(np.int64) - 1
+    gy1 = np.floor(np.maximum(ya, yb) / cell_lat).astype(np.int64) + 1
+    # A piece spans at most two cells per axis (three allowing for rounding),
+    # so its widened box at most five.
+    span = np.arange(5)
+    gx = gx0[:, None, None] + span[None, :, None]
+    gy = gy0[:, None, None] + span[None, None, :]
+    inside = (gx <= gx1[:, None, None]) & (gy <= gy1[:, None, None])
+    shape = inside.shape
+    entries = np.unique(
+        np.stack(
+            (
+                np.broadcast_to(seg[:, None, None], shape)[inside],
+                np.broadcast_to(gx, shape)[inside],
+                np.broadcast_to(gy, shape)[inside],
+            ),
+            axis=1,
+        ),
+        axis=0,
+    )
+
+    px = np.floor(lon / cell_lon).astype(np.int64)
+    py = np.floor(lat / cell_lat).astype(np.int64)
+    cells, inverse = np.unique(np.stack((px, py), axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # Number segment cells and point cells on one scale to match them up.
+    _, ids = np.unique(np.concatenate((entries[:, 1:], cells)), axis=0, return_inverse=True)
+    ids = ids.reshape(-1)
+    entry_ids, cell_ids = ids[: len(entries)], ids[len(entries) :]
+    by_id = np.argsort(entry_ids, kind="stable")
+    entry_ids, entry_segs = entry_ids[by_id], entries[by_id, 0]
+    seg_lo = np.searchsorted(entry_ids, cell_ids, side="left")
+    seg_hi = np.searchsorted(entry_ids, cell_ids, side="right")
+    # Crowded cells are compared in one broadcast each; the remaining points,
+    # often one per cell at small radii, go through in shared batches.
+    crowded = np.bincount(inverse, minlength=len(cells)) >= GRID_CROWDED_CELL
+    sparse = ~crowded[inverse]
+    dist, along = np.full(len(lon), np.inf), np.zeros(len(lon))
+    first = seg_lo[inverse[sparse]]
+    dist[sparse], along[sparse] = _nearest_candidates(
+        lon[sparse], lat[sparse], line, entry_segs, first, seg_hi[inverse[sparse]] - first, seg_len, seg_start
+    )
+    by_cell = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[by_cell], np.arange(len(cells) + 1))
+    for cell in np.flatnonzero(crowded & (seg_hi > seg_lo)):
+        idx = by_cell[bounds[cell] : bounds[cell + 1]]
+        segs = entry_segs[seg_lo[cell] : seg_hi[cell]]
+        dist[idx], along[idx] = _nearest(lon[idx], lat[idx], line, segs, seg_len, seg_start)
+    return dist, along
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import math
+import struct
+import sys
+from array import array
+from typing import Any, Iterable
+
+# WKB geometry type codes and the PostGIS EWKB flag bits.
+POINT = 1
+LINESTRING = 2
+_TYPE_NAMES = {POINT: "Point", LINESTRING: "LineString"}
+_EWKB_Z = 0x80000000
+_EWKB_M = 0x40000000
+_EWKB_SRID = 0x20000000
+
+DEFAULT_SRID = 4326
+_NATIVE_LITTLE = sys.byteorder == "little"
+
+
+class Geometry:
+    """A Point or LineString whose coordinates live in one flat ``array('d')``.
+
+    This is what the asyncpg geometry codec decodes to and encodes from, so
+    geometries cross the wire as binary EWKB instead of GeoJSON or WKT text.
+    Only x/y are kept; Z and M ordinates are dropped on decode.
+    """
+
+    __slots__ = ("kind", "coords", "srid")
+
+    def __init__(self, kind: int, coords: array, srid: int = DEFAULT_SRID) -> None:
+        if kind not in _TYPE_NAMES:
+            raise ValueError(f"Unsupported geometry type {kind}")
+        self.kind = kind
+        self.coords = coords
+        self.srid = srid
+
+    @classmethod
+    def point(cls, lon: float, lat: float, srid: int = DEFAULT_SRID) -> Geometry:
+        return cls(POINT, array("d", (lon, lat)), srid)
+
+    @classmethod
+    def line_string(cls, positions: Iterable[Any], srid: int = DEFAULT_SRID) -> Geometry:
+        coords = array("d")
+        for position in positions:
+            coords.append(position[0])
+            coords.append(position[1])
+        return cls(LINESTRING, coords, srid)
+
+    def __len__(self) -> int:
+        return len(self.coords) // 2
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Geometry):
+            return NotImplemented
+        return (self.kind, self.srid, self.coords) == (other.kind, other.srid, other.coords)
+
+    def __repr__(self) -> str:
+        return f"Geometry({_TYPE_NAMES[self.kind]}, {len(self)} points, srid={self.srid})"
+
+    def positions(self) -> list[list[float]]:
+        coords = self.coords
+        return [[coords[i], coords[i + 1]] for i in range(0, len(coords), 2)]
+
+    def geojson(self) -> dict[str, Any]:
+        if self.kind == POINT:
+            return {"type": "Point", "coordinates": [self.coords[0], self.coords[1]]}
+        return {"type": "LineString", "coordinates": self.positions()}
+
+
+def validated_line_string(coords: array) -> Geometry:
+    """Check flat lon/lat ordinates and wrap them as a LineString.
+
+    Raises ValueError with a message fit for a client on anything PostGIS
+    would reject or that cannot be a route: non-finite ordinates, positions
+    outside lon/lat range, or fewer than two distinct positions.
+    """
+
+    for index in range(0, len(coords), 2):
+        lon, lat = coords[index], coords[index + 1]
+        if not (math.isfinite(lon) and math.isfinite(lat)):
+            raise ValueError(f"Position {index // 2} has non-finite ordinates")
+        if not (-180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0):
+            raise ValueError(f"Position {index // 2} is outside longitude/latitude range")
+    if len(coords) < 4:
+        raise ValueError("LineString must contain at least two positions")
+    if all(coords[i] == coords[0] and coords[i + 1] == coords[1] for i in range(2, len(coords), 2)):
+        raise ValueError("LineString must contain at least two distinct positions")
+    return Geometry(LINESTRING, coords)
+
+
+def line_string_from_geojson(geojson: Any) -> Geometry:
+    """Validate a GeoJSON LineString (or a Feature holding one) into a Geometry."""
+
+    if isinstance(geojson, dict) and geojson.get("type") == "Feature":
+        geojson = geojson.get("geometry")
+    if not isinstance(geojson, dict) or geojson.get("type") != "LineString":
+        raise ValueError("GeoJSON geometry must be a LineString")
+    positions = geojson.get("coordinates")
+    if not isinstance(positions, list):
+        raise ValueError("LineString coordinates must be a list of positions")
+    coords = array("d")
+    for index, position in enumerate(positions):
+        if not isinstance(position, (list, tuple)) or len(position) < 2:
+            raise ValueError(f"Position {index} must have at least two ordinates")
+        lon, lat = position[0], position[1]
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (lon, lat)):
+            raise ValueError(f"Position {index} has non-numeric ordinates")
+        try:
+            coords.append(float(lon))
+            coords.append(float(lat))
+        except OverflowError as exc:
+            raise ValueError(f"Position {index} has out-of-range ordinates") from exc
+    return validated_line_string(coords)
+
+
+def encode_ewkb(geom: Geometry) -> bytes:
+    """Serialise to little-endian EWKB with an embedded SRID."""
+
+    coords = geom.coords if _NATIVE_LITTLE else _swapped(geom.coords)
+    header = struct.pack("<BII", 1, geom.kind | _EWKB_SRID, geom.srid)
+    if geom.kind == POINT:
+        return header + coords.tobytes()
+    return header + struct.pack("<I", len(geom)) + coords.tobytes()
+
+
+def decode_ewkb(data: bytes) -> Geometry:
+    """Parse the (E)WKB PostGIS sends for a Point or LineString."""
+
+    little = data[0] == 1
+    prefix = "<" if little else ">"
+    (type_word,) = struct.unpack_from(prefix + "I", data, 1)
+    offset = 5
+    srid = 0
+    if type_word & _EWKB_SRID:
+        (srid,) = struct.unpack_from(prefix + "I", data, offset)
+        offset += 4
+    dims = 2 + bool(type_word & _EWKB_Z) + bool(type_word & _EWKB_M)
+    kind = type_word & 0x0FFFFFFF
+    if kind == POINT:
+        count = 1
+    elif kind == LINESTRING:
+        (count,) = struct.unpack_from(prefix + "I", data, offset)
+        offset += 4
+    else:
+        raise ValueError(f"Unsupported geometry type {kind}")
+
+    coords = array("d")
+    coords.frombytes(data[offset : offset + count * dims * 8])
+    if little != _NATIVE_LITTLE:
+        coords.byteswap()
+    if dims != 2:
+        coords = array("d", (c for i, c in enumerate(coords) if i % dims < 2))
+    return Geometry(kind, coords, srid)
+
+
+def _swapped(coords: array) -> array:
+    copy = array("d", coords)
+    copy.byteswap()
+    return copy
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+from array import array
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Optional
+from xml.etree.ElementTree import ParseError, XMLPullParser
 
 import gpxpy.gpx
 
@@ -10,6 +12,71 @@ class GPXBuildError(Exception):
     """Raised when GPX output cannot be produced."""
 
 
+class GPXParseError(ValueError):
+    """Raised when an uploaded GPX document cannot be read."""
+
+
+def _local(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+class GPXTrackReader:
+    """Incrementally extract track points from GPX bytes fed in chunks.
+
+    Only ``trkpt`` coordinates and the document name are kept: points go
+    into a flat ``array('d')`` of lon/lat and every element is detached from
+    its parent once closed, so memory stays proportional to the points rather
+    than to the document tree.
+    """
+
+    def __init__(self) -> None:
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._path: list[str] = []
+        self._stack: list = []
+        self.name: Optional[str] = None
+        self.coords = array("d")
+
+    def feed(self, chunk: bytes) -> None:
+        try:
+            self._parser.feed(chunk)
+        except ParseError as exc:
+            raise GPXParseError(f"Malformed GPX: {exc}") from exc
+        self._drain()
+
+    def close(self) -> tuple[Optional[str], array]:
+        """Finish parsing and return ``(name, coords)``."""
+
+        try:
+            self._parser.close()
+        except ParseError as exc:
+            raise GPXParseError(f"Malformed GPX: {exc}") from exc
+        self._drain()
+        return self.name, self.coords
+
+    def _drain(self) -> None:
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                tag = _local(elem.tag)
+                self._path.append(tag)
+                self._stack.append(elem)
+                if tag == "trkpt" and self._path[-2:-1] == ["trkseg"]:
+                    try:
+                        self.coords.append(float(elem.attrib["lon"]))
+                        self.coords.append(float(elem.attrib["lat"]))
+                    except (KeyError, ValueError) as exc:
+                        raise GPXParseError("Track point without valid lat/lon") from exc
+                continue
+
+            # GPX 1.1 names the document in <metadata>, GPX 1.0 directly under <gpx>.
+            if self.name is None and self._path in (["gpx", "metadata", "name"], ["gpx", "name"]):
+                self.name = (elem.text or "").strip() or None
+            self._path.pop()
+            self._stack.pop()
+            if self._stack:
+                # The closed element is always its parent's last child.
+                del self._stack[-1][-1]
+
+
 def build_gpx(
     route: dict,
     pois: Iterable[dict],
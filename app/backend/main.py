@@ -1,58 +1,70 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import binascii
+import gzip
 import hashlib
 import json
+import logging
+import mimetypes
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Literal, Optional
 from uuid import UUID, uuid4
 
-import asyncpg
-import gpxpy
 import orjson
 from fastapi import (
+    BackgroundTasks,
     Body,
     Depends,
     FastAPI,
     File,
     Form,
+    Header,
     HTTPException,
     Query,
     Response,
     UploadFile,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from redis import Redis
 from rq import Queue
 from rq.exceptions import NoSuchJobError
 from rq.job import Job
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 import cache
+import dataset
+import memory_index
+import route_cache
+import search
+import search_cache
+import tile_archive
+import tiles
 from config import settings
 from db import Database, get_db, init_db
-from queries import GEOJSON_TO_WKT_SQL, ROUTE_GEOJSON_SQL, SEARCH_SQL
-from worker import QUEUE_NAME, process_gpx_job
+from geometry import Geometry, line_string_from_geojson, validated_line_string
+from fit import FITParseError, FITTrackReader, is_fit
+from gpx import GPXParseError, GPXTrackReader
+from queries import INSERT_ROUTE_SQL, METATILE_MVT_SQL, MVT_SQL
+from tcx import TCXParseError, TCXTrackReader
+from worker import QUEUE_NAME, process_gpx_job, render_tile_pyramid
 
-GPX_QUEUE_NAME = QUEUE_NAME
-SEARCH_CACHE_TTL = 90
-MVT_CACHE_TTL = 600
+logger = logging.getLogger(__name__)
 
-MVT_SQL = """
-WITH bounds AS (
-  SELECT ST_TileEnvelope($1, $2, $3) AS geom_3857
-)
-SELECT ST_AsMVT(tile, 'amenities', 4096, 'geom') FROM (
-  SELECT
-    a.id,
-    a.category,
-    a.props,
-    ST_AsMVTGeom(ST_Transform(a.geom, 3857), bounds.geom_3857, 4096, 64, true) AS geom
-  FROM amenities a, bounds
-  WHERE ST_Intersects(ST_Transform(a.geom, 3857), bounds.geom_3857)
-    AND ($4::text[] IS NULL OR a.category = ANY($4::text[]))
-) AS tile;
-"""
+GPX_QUEUE_NAME = QUEUE_NAME
+TILE_PYRAMID_JOB_TIMEOUT = 60 * 60 * 6
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Cache keys embed the amenities dataset version, so these TTLs only bound
+# memory use; data changes make entries unreachable immediately.
+SEARCH_CACHE_TTL = 60 * 60 * 6
+SEARCH_CACHE_STALE_TTL = 60 * 60
+MVT_CACHE_TTL = 60 * 60 * 24
+MVT_CACHE_STALE_TTL = 60 * 60 * 6
 
 
 class GeoJSONLineString(BaseModel):
@@ -74,12 +86,38 @@ class AmenityFeature(BaseModel):
     category: str
     props: dict[str, Any] | None = None
     distance_m: float | None = None
+    along_fraction: float | None = None
+    along_km: float | None = None
     geometry: dict[str, Any]
 
 
 class SearchResponse(BaseModel):
     route: dict[str, Any]
     items: list[AmenityFeature]
+    next_cursor: str | None = None
+
+
+class BatchSearchItem(BaseModel):
+    key: str | None = Field(None, description="Result key; defaults to the request's index")
+    route_id: UUID
+    radius_m: float = Field(500.0, gt=0)
+    filters: list[str] | None = None
+    radii: dict[str, float] | None = None
+    order: Literal["distance", "along"] = "distance"
+    limit: int = Field(search.SEARCH_LIMIT, ge=1, le=search.SEARCH_LIMIT)
+
+
+class BatchSearchRequest(BaseModel):
+    requests: list[BatchSearchItem] = Field(min_length=1)
+
+
+class BatchSearchResult(BaseModel):
+    result: SearchResponse | None = None
+    error: str | None = None
+
+
+class BatchSearchResponse(BaseModel):
+    results: dict[str, BatchSearchResult]
 
 
 class ExportRequest(BaseModel):
@@ -87,6 +125,13 @@ class ExportRequest(BaseModel):
     radius_m: float = Field(gt=0)
     filters: list[str] | None = None
     poi_ids: list[UUID] | None = None
+    format: Literal["gpx", "fit"] = "gpx"
+
+
+class TilePyramidRequest(BaseModel):
+    bbox: list[float] = Field(min_length=4, max_length=4, description="west, south, east, north")
+    min_zoom: int = Field(0, ge=0, le=22)
+    max_zoom: int = Field(14, ge=0, le=22)
 
 
 class ExportJobResponse(BaseModel):
@@ -98,8 +143,46 @@ class ExportStatusResponse(BaseModel):
     url: str | None = None
 
 
+class UploadLimitMiddleware:
+    """Cap POST /routes request bodies at MAX_UPLOAD_BYTES before they are parsed.
+
+    Starlette spools the whole multipart body before the endpoint runs, so the
+    cap has to sit in front of it: an oversized Content-Length is refused
+    unread, and a chunked body is cut off once it crosses the cap.
+    """
+
+    def __init__(self, app: ASGIApp, path: str, limit: int) -> None:
+        self.app = app
+        self.path = path
+        self.limit = limit
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        declared = Headers(scope=scope).get("content-length", "")
+        if declared.isdigit() and int(declared) > self.limit:
+            response = JSONResponse({"detail": "Upload exceeds MAX_UPLOAD_BYTES"}, status_code=413)
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    # FastAPI re-raises HTTPExceptions from body parsing as-is.
+                    raise HTTPException(status_code=413, detail="Upload exceeds MAX_UPLOAD_BYTES")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
 app = FastAPI(title="Route Amenities Demo")
 
+app.add_middleware(UploadLimitMiddleware, path="/routes", limit=settings.max_upload_bytes)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -110,20 +193,27 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def on_startup() -> None:
-    await init_db()
+    db = await init_db()
+    await dataset.init_versions(db)
     await cache.init_redis()
+    if settings.search_engine == "memory":
+        # Load up front so the first search does not pay for it.
+        await memory_index.get_index(db)
     Path(settings.gpx_output_dir).mkdir(parents=True, exist_ok=True)
     app.state.redis_queue = Queue(GPX_QUEUE_NAME, connection=Redis.from_url(settings.redis_url))
 
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
+    await dataset.close_versions()
     await cache.close_redis()
     queue: Queue | None = getattr(app.state, "redis_queue", None)
     if queue is not None:
         queue.connection.close()
 
 
+# Served from /files; not in the default mimetypes table.
+mimetypes.add_type("application/vnd.ant.fit", ".fit")
 app.mount(
     "/files",
     StaticFiles(directory=settings.gpx_output_dir),
@@ -145,18 +235,65 @@ def parse_filters(filters_param: str | None) -> list[str] | None:
     return [filters_param]
 
 
-def make_search_cache_key(route_wkb_hex: str, radius_m: float, filters: list[str] | None) -> str:
-    payload = {
-        "route": route_wkb_hex,
-        "radius": radius_m,
-        "filters": sorted(filters) if filters else [],
-    }
-    digest = hashlib.sha1(orjson.dumps(payload)).hexdigest()
-    return f"q:{digest}"
+def parse_radii(radii_param: str | None) -> dict[str, float] | None:
+    if not radii_param:
+        return None
+    try:
+        parsed = json.loads(radii_param)
+    except json.JSONDecodeError as exc:
+        raise HTTPException(status_code=400, detail="radii must be a JSON object") from exc
+    return check_radii(parsed)
+
+
+def check_radii(parsed: Any) -> dict[str, float]:
+    if not isinstance(parsed, dict) or not parsed:
+        raise HTTPException(status_code=400, detail="radii must be a non-empty JSON object")
+    radii: dict[str, float] = {}
+    for category, radius in parsed.items():
+        if isinstance(radius, bool) or not isinstance(radius, (int, float)) or radius <= 0:
+            raise HTTPException(status_code=400, detail=f"Invalid radius for category {category!r}")
+        radii[str(category)] = float(radius)
+    return radii
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    """Whether an Accept-Encoding header admits gzip (explicitly or via ``*``)."""
+
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        name, _, value = params.strip().partition("=")
+        if name.strip().lower() != "q":
+            return True
+        try:
+            return float(value) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def encode_cursor(order: str, value: float, amenity_id: UUID | str) -> str:
+    raw = orjson.dumps([order, value, str(amenity_id)])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order: str) -> tuple[float, UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_order, value, amenity_id = orjson.loads(raw)
+        parsed = (float(value), UUID(amenity_id))
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if cursor_order != order:
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different order")
+    return parsed
 
 
 def make_mvt_cache_key(z: int, x: int, y: int, filters: list[str] | None) -> str:
     payload = {
+        "dataset": dataset.current_version(dataset.AMENITIES),
+        "tile": dataset.tile_generation(z, x, y),
         "z": z,
         "x": x,
         "y": y,
@@ -166,31 +303,88 @@ def make_mvt_cache_key(z: int, x: int, y: int, filters: list[str] | None) -> str
     return f"mvt:amenities:{digest}"
 
 
-async def ensure_route(db: Database, route_id: UUID) -> asyncpg.Record:
-    record = await db.fetchrow(ROUTE_GEOJSON_SQL, route_id)
-    if record is None:
+async def ensure_route(db: Database, route_id: UUID) -> dict[str, Any]:
+    meta = await route_cache.get_route_meta(db, route_id)
+    if meta is None:
         raise HTTPException(status_code=404, detail="Route not found")
-    return record
-
-
-async def convert_geojson_to_wkt(db: Database, geojson: dict[str, Any]) -> str:
-    geojson_str = orjson.dumps(geojson).decode()
-    wkt = await db.fetchval(GEOJSON_TO_WKT_SQL, geojson_str)
-    if not wkt:
-        raise HTTPException(status_code=400, detail="Invalid GeoJSON geometry")
-    return wkt
-
-
-async def insert_route(db: Database, route_id: UUID, name: str, wkt: str) -> None:
-    await db.execute(
-        """
-        INSERT INTO routes(route_id, name, geom, created_at)
-        VALUES($1, $2, ST_GeomFromText($3, 4326), NOW())
-        """,
-        route_id,
-        name,
-        wkt,
-    )
+    return meta
+
+
+def track_reader(filename: str | None, head: bytes) -> Any:
+    """Pick a GPX, TCX or FIT reader from the file extension, else the first bytes."""
+
+    suffix = Path(filename or "").suffix.lower()
+    if suffix == ".fit" or (suffix not in (".gpx", ".tcx") and is_fit(head)):
+        return FITTrackReader()
+    if suffix == ".tcx" or (suffix != ".gpx" and b"<TrainingCenterDatabase" in head):
+        return TCXTrackReader()
+    return GPXTrackReader()
+
+
+async def read_track_upload(upload: UploadFile) -> tuple[Optional[str], Geometry]:
+    """Feed an uploaded GPX/TCX/FIT file through its track reader chunk by chunk.
+
+    The size cap is enforced on the request body by UploadLimitMiddleware.
+    """
+
+    reader = None
+    try:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            if reader is None:
+                reader = track_reader(upload.filename, chunk)
+            reader.feed(chunk)
+        if reader is None:
+            raise HTTPException(status_code=400, detail="Empty track file")
+        name, coords = reader.close()
+    except (GPXParseError, TCXParseError, FITParseError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if len(coords) < 4:
+        raise HTTPException(status_code=400, detail="Track must contain at least two points")
+    try:
+        return name, validated_line_string(coords)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid track: {exc}") from exc
+
+
+def route_geometry(geojson: Any) -> Geometry:
+    try:
+        return line_string_from_geojson(geojson)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid GeoJSON geometry: {exc}") from exc
+
+
+async def insert_route(db: Database, route_id: UUID, name: str, geom: Geometry) -> dict[str, Any]:
+    length_m = await db.fetchval(INSERT_ROUTE_SQL, route_id, name, geom)
+    return route_cache.build_route_meta(route_id, name, geom, length_m)
+
+
+async def render_metatile(
+    db: Database,
+    z: int,
+    x: int,
+    y: int,
+    filters: list[str] | None,
+) -> dict[tuple[int, int], bytes]:
+    """Render the metatile containing (z, x, y) and cache all of its tiles.
+
+    Concurrent misses anywhere in the same block share one query.
+    """
+
+    shift = min(max(settings.mvt_metatile_size, 1).bit_length() - 1, z)
+    mx, my = x >> shift, y >> shift
+    filters_part = ",".join(sorted(filters)) if filters else ""
+
+    async def render() -> dict[tuple[int, int], bytes]:
+        rows = await db.fetch(METATILE_MVT_SQL, z, shift, mx, my, filters or None)
+        rendered = {(row["x"], row["y"]): row["mvt"] or b"" for row in rows}
+        await cache.set_many_bytes(
+            {make_mvt_cache_key(z, tx, ty, filters): tile for (tx, ty), tile in rendered.items()},
+            MVT_CACHE_TTL,
+            stale_ttl=MVT_CACHE_STALE_TTL,
+        )
+        return rendered
+
+    return await cache.coalesce(f"mvt:meta:{z}/{shift}/{mx}/{my}:{filters_part}", render)
 
 
 def get_queue() -> Queue:
@@ -213,8 +407,14 @@ async def healthz(db: Database = Depends(get_db)) -> dict[str, Any]:
     return {"status": "ok"}
 
 
+@app.get("/cache/stats")
+async def cache_stats() -> dict[str, Any]:
+    return {**cache.stats(), "derived_searches": search_cache.stats()["derived"]}
+
+
 @app.post("/routes", response_model=RouteCreateResponse, status_code=201)
 async def create_route(
+    background_tasks: BackgroundTasks,
     db: Database = Depends(get_db),
     payload: RouteCreateRequest | None = Body(None),
     gpx_file: UploadFile | None = File(None),
@@ -223,76 +423,226 @@ async def create_route(
 ) -> RouteCreateResponse:
     route_id = uuid4()
     route_name: str
-    wkt: str
+    geom: Geometry
 
     if gpx_file is not None:
-        contents = await gpx_file.read()
-        if not contents:
-            raise HTTPException(status_code=400, detail="Empty GPX file")
-        gpx = gpxpy.parse(contents.decode())
-        points: list[tuple[float, float]] = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    points.append((point.longitude, point.latitude))
-        if len(points) < 2:
-            raise HTTPException(status_code=400, detail="GPX must contain at least two points")
-        coords = ", ".join(f"{lon} {lat}" for lon, lat in points)
-        wkt = f"LINESTRING({coords})"
-        route_name = name or gpx.name or "Uploaded route"
+        track_name, geom = await read_track_upload(gpx_file)
+        route_name = name or track_name or "Uploaded route"
     elif payload is not None:
         route_name = payload.name
-        wkt = await convert_geojson_to_wkt(db, payload.geojson.model_dump())
+        geom = route_geometry(payload.geojson.model_dump())
     elif geojson:
         try:
             parsed = json.loads(geojson)
         except json.JSONDecodeError as exc:
             raise HTTPException(status_code=400, detail="Invalid GeoJSON in form field") from exc
         route_name = name or "Route"
-        wkt = await convert_geojson_to_wkt(db, parsed)
+        geom = route_geometry(parsed)
     else:
-        raise HTTPException(status_code=400, detail="Provide GeoJSON payload or GPX upload")
+        raise HTTPException(status_code=400, detail="Provide GeoJSON payload or GPX/TCX/FIT upload")
 
-    await insert_route(db, route_id, route_name, wkt)
+    meta = await insert_route(db, route_id, route_name, geom)
+    await route_cache.put_route_meta(meta)
+    background_tasks.add_task(search.precompute_corridors, db, route_id)
+    background_tasks.add_task(search.ensure_route_index, db, route_id, settings.route_index_radius_m)
     return RouteCreateResponse(route_id=route_id)
 
 
+def amenity_from_row(row: Any, route_length_m: float) -> AmenityFeature:
+    along_m = row["along_m"]
+    return AmenityFeature(
+        id=row["id"],
+        category=row["category"],
+        props=row["props"],
+        distance_m=float(row["dist_m"]) if row["dist_m"] is not None else None,
+        along_fraction=along_m / route_length_m if along_m is not None and route_length_m > 0 else None,
+        along_km=along_m / 1000.0 if along_m is not None else None,
+        geometry=row["geom"].geojson(),
+    )
+
+
+async def cached_search(
+    db: Database,
+    route: dict[str, Any],
+    radius_m: float,
+    filters_list: list[str] | None,
+    order: str = "distance",
+    window_km: tuple[float, float] | None = None,
+    radii_map: dict[str, float] | None = None,
+    cursor: str | None = None,
+    limit: int = search.SEARCH_LIMIT,
+) -> dict[str, Any]:
+    """Return one /search page as a JSON-ready dict, served through the cache tiers."""
+
+    route_id = UUID(route["route_id"])
+    route_info = {
+        "route_id": route["route_id"],
+        "name": route["name"],
+        "geometry": route["geometry"],
+    }
+    categories = filters_list or None
+    after = decode_cursor(cursor, order) if cursor else None
+    cache_key = search_cache.make_search_cache_key(
+        route, radius_m, filters_list, order, window_km, cursor, limit, radii_map
+    )
+
+    async def query_search() -> SearchResponse:
+        if radii_map is not None:
+            rows = await search.search_category_radii(db, route_id, radii_map, order=order, after=after, limit=limit)
+        elif window_km is not None:
+            rows = await search.search_window(
+                db, route_id, radius_m, categories, *window_km, order=order, after=after, limit=limit
+            )
+        else:
+            rows = await search.search_amenities(
+                db, route_id, radius_m, categories, route["length_m"], order=order, after=after, limit=limit
+            )
+        items = [amenity_from_row(row, route["length_m"]) for row in rows]
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = encode_cursor(order, search.sort_value(last, order), last["id"])
+        return SearchResponse(route=route_info, items=items, next_cursor=next_cursor)
+
+    async def run_search() -> dict[str, Any]:
+        # Derivation tracks single-radius results only.
+        reusable = cursor is None and radii_map is None
+        derived = None
+        if reusable:
+            derived = await search_cache.derive(route, radius_m, filters_list, order, window_km, limit)
+        response = SearchResponse(route=route_info, items=derived) if derived is not None else await query_search()
+        if reusable and response.next_cursor is None:
+            await search_cache.remember(
+                route, radius_m, filters_list, order, window_km, limit, SEARCH_CACHE_TTL + SEARCH_CACHE_STALE_TTL
+            )
+        return response.model_dump(mode="json")
+
+    return await cache.get_or_compute_json(
+        cache_key, SEARCH_CACHE_TTL, run_search, stale_ttl=SEARCH_CACHE_STALE_TTL
+    )
+
+
+def search_scope(
+    radius_m: float,
+    filters_list: list[str] | None,
+    radii_map: dict[str, float] | None,
+) -> tuple[float, list[str] | None]:
+    """A category -> radius map replaces both the radius and the filters."""
+
+    if radii_map is None:
+        return radius_m, filters_list
+    if filters_list:
+        raise HTTPException(status_code=400, detail="radii cannot be combined with filters")
+    return max(radii_map.values()), sorted(radii_map)
+
+
 @app.get("/search", response_model=SearchResponse)
 async def search_route_amenities(
     route_id: UUID = Query(...),
     radius_m: float = Query(500.0, gt=0),
     filters: str | None = Query(None),
+    radii: str | None = Query(None),
+    order: Literal["distance", "along"] = Query("distance"),
+    from_km: float | None = Query(None, ge=0),
+    to_km: float | None = Query(None, ge=0),
+    limit: int = Query(search.SEARCH_LIMIT, ge=1, le=search.SEARCH_LIMIT),
+    cursor: str | None = Query(None),
+    format: Literal["json", "ndjson"] = Query("json"),
     db: Database = Depends(get_db),
-) -> SearchResponse:
-    record = await ensure_route(db, route_id)
-    route_geojson = json.loads(record["geojson"])
-    route_info = {
-        "route_id": str(route_id),
-        "name": record["name"],
-        "geometry": route_geojson,
-    }
-    filters_list = parse_filters(filters)
-    cache_key = make_search_cache_key(record["wkb_hex"], radius_m, filters_list)
-
-    cached = await cache.get_json(cache_key)
-    if cached:
-        return SearchResponse(**cached)
-
-    categories = filters_list or None
-    rows = await db.fetch(SEARCH_SQL, route_id, radius_m, categories)
-    items = [
-        AmenityFeature(
-            id=row["id"],
-            category=row["category"],
-            props=row["props"],
-            distance_m=float(row["dist_m"]) if row["dist_m"] is not None else None,
-            geometry=json.loads(row["geojson"]),
+) -> SearchResponse | StreamingResponse:
+    route = await ensure_route(db, route_id)
+    radii_map = parse_radii(radii)
+    radius_m, filters_list = search_scope(radius_m, parse_filters(filters), radii_map)
+    window_km: tuple[float, float] | None = None
+    if from_km is not None or to_km is not None:
+        if radii_map is not None:
+            raise HTTPException(status_code=400, detail="radii cannot be combined with from_km/to_km")
+        window_km = (from_km or 0.0, to_km if to_km is not None else route["length_m"] / 1000.0)
+        if window_km[1] < window_km[0]:
+            raise HTTPException(status_code=400, detail="to_km must be >= from_km")
+
+    if format == "ndjson":
+        # Streamed straight from a server-side cursor: no row cap, no caching.
+        after = decode_cursor(cursor, order) if cursor else None
+
+        async def stream() -> Any:
+            rows = search.iter_amenities(
+                db,
+                route_id,
+                radius_m,
+                filters_list or None,
+                order=order,
+                after=after,
+                window_km=window_km,
+                radii=radii_map,
+            )
+            async for row in rows:
+                yield orjson.dumps(amenity_from_row(row, route["length_m"]).model_dump(mode="json")) + b"\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    payload = await cached_search(db, route, radius_m, filters_list, order, window_km, radii_map, cursor, limit)
+    return SearchResponse(**payload)
+
+
+@app.post("/search/batch", response_model=BatchSearchResponse)
+async def batch_search(request: BatchSearchRequest, db: Database = Depends(get_db)) -> BatchSearchResponse:
+    """Run many single-page searches: cache hits come from one MGET, misses run concurrently."""
+
+    if len(request.requests) > settings.search_batch_max_requests:
+        raise HTTPException(
+            status_code=400, detail=f"At most {settings.search_batch_max_requests} requests per batch"
         )
-        for row in rows
+    keys = [item.key if item.key is not None else str(index) for index, item in enumerate(request.requests)]
+    if len(set(keys)) != len(keys):
+        raise HTTPException(status_code=400, detail="Duplicate request keys")
+
+    routes = await route_cache.get_route_metas(db, [item.route_id for item in request.requests])
+    results: dict[str, BatchSearchResult] = {}
+    pending: list[tuple[str, BatchSearchItem, dict[str, Any], float, list[str] | None, dict[str, float] | None]] = []
+    for key, item in zip(keys, request.requests):
+        route = routes.get(str(item.route_id))
+        if route is None:
+            results[key] = BatchSearchResult(error="Route not found")
+            continue
+        try:
+            radii_map = check_radii(item.radii) if item.radii is not None else None
+            radius_m, filters_list = search_scope(item.radius_m, item.filters or None, radii_map)
+        except HTTPException as exc:
+            results[key] = BatchSearchResult(error=str(exc.detail))
+            continue
+        pending.append((key, item, route, radius_m, filters_list, radii_map))
+
+    cache_keys = [
+        search_cache.make_search_cache_key(route, radius_m, filters_list, item.order, None, None, item.limit, radii_map)
+        for _, item, route, radius_m, filters_list, radii_map in pending
     ]
-    response = SearchResponse(route=route_info, items=items)
-    await cache.set_json(cache_key, response.model_dump(mode="json"), SEARCH_CACHE_TTL)
-    return response
+    cached = await cache.get_many_json(cache_keys)
+    semaphore = asyncio.Semaphore(settings.search_batch_concurrency)
+
+    async def run(entry: tuple[Any, ...]) -> BatchSearchResult:
+        # A failing item only fails its own result, never the batch.
+        key, item, route, radius_m, filters_list, radii_map = entry
+        async with semaphore:
+            try:
+                payload = await cached_search(
+                    db, route, radius_m, filters_list, item.order, None, radii_map, None, item.limit
+                )
+            except HTTPException as exc:
+                return BatchSearchResult(error=str(exc.detail))
+            except Exception:
+                logger.exception("batch search %r failed", key)
+                return BatchSearchResult(error="Search failed")
+        return BatchSearchResult(result=payload)
+
+    misses = [entry for entry, payload in zip(pending, cached) if payload is None]
+    computed = await asyncio.gather(*(run(entry) for entry in misses))
+    for entry, payload in zip(pending, cached):
+        if payload is not None:
+            results[entry[0]] = BatchSearchResult(result=payload)
+    for entry, result in zip(misses, computed):
+        results[entry[0]] = result
+    return BatchSearchResponse(results={key: results[key] for key in keys})
 
 
 @app.post("/export/gpx", response_model=ExportJobResponse)
@@ -301,6 +651,20 @@ async def export_gpx(request: ExportRequest, q: Queue = Depends(get_queue)) -> E
     return ExportJobResponse(job_id=job.id)
 
 
+@app.post("/tiles/pyramid", response_model=ExportJobResponse)
+async def build_tile_pyramid(request: TilePyramidRequest, q: Queue = Depends(get_queue)) -> ExportJobResponse:
+    if request.max_zoom < request.min_zoom:
+        raise HTTPException(status_code=400, detail="max_zoom must be >= min_zoom")
+    if not tiles.valid_bbox(request.bbox):
+        raise HTTPException(status_code=400, detail="bbox must be west < east and south < north within lon/lat range")
+    if tiles.pyramid_tile_count(request.bbox, request.min_zoom, request.max_zoom) > settings.mvt_pyramid_max_tiles:
+        raise HTTPException(
+            status_code=400, detail=f"Tile pyramid exceeds {settings.mvt_pyramid_max_tiles} tiles"
+        )
+    job = q.enqueue(render_tile_pyramid, request.model_dump(), job_timeout=TILE_PYRAMID_JOB_TIMEOUT)
+    return ExportJobResponse(job_id=job.id)
+
+
 @app.get("/export/status/{job_id}", response_model=ExportStatusResponse)
 async def export_status(job_id: str) -> ExportStatusResponse:
     redis_conn = Redis.from_url(settings.redis_url)
@@ -328,17 +692,32 @@ async def amenities_tile(
     x: int,
     y: int,
     filters: str | None = Query(None),
+    accept_encoding: str | None = Header(None),
     db: Database = Depends(get_db),
 ) -> Response:
     filters_list = parse_filters(filters)
+    # Archived tiles are stored gzipped; the encoding served depends on the client.
+    headers = {"Vary": "Accept-Encoding"}
+    if filters_list is None:
+        archived = tile_archive.lookup(settings.mvt_archive_path, z, x, y)
+        if archived is not None:
+            if archived and accepts_gzip(accept_encoding):
+                headers["Content-Encoding"] = "gzip"
+            elif archived:
+                archived = gzip.decompress(archived)
+            return Response(content=archived, media_type="application/vnd.mapbox-vector-tile", headers=headers)
+
     cache_key = make_mvt_cache_key(z, x, y, filters_list)
-    cached = await cache.get_bytes(cache_key)
-    if cached:
-        return Response(content=cached, media_type="application/vnd.mapbox-vector-tile")
 
-    categories = filters_list or None
-    row = await db.fetchrow(MVT_SQL, z, x, y, categories)
-    tile = row["st_asmvt"] if row and row["st_asmvt"] else b""
+    async def render_tile() -> bytes:
+        if settings.mvt_metatile_size > 1:
+            rendered = await render_metatile(db, z, x, y, filters_list)
+            return rendered.get((x, y), b"")
+        categories = filters_list or None
+        row = await db.fetchrow(MVT_SQL, z, x, y, categories)
+        return row["st_asmvt"] if row and row["st_asmvt"] else b""
 
-    await cache.set_bytes(cache_key, tile, MVT_CACHE_TTL)
-    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile")
+    tile = await cache.get_or_compute_bytes(
+        cache_key, MVT_CACHE_TTL, render_tile, stale_ttl=MVT_CACHE_STALE_TTL
+    )
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Optional
+from uuid import UUID
+
+import numpy as np
+
+import dataset
+import geo
+from cell_search import CELL_ZOOM, covering_cells
+from db import Database
+from geometry import Geometry
+from queries import AMENITY_INDEX_SQL, CELL_AMENITIES_SQL
+from tiles import MAX_LATITUDE
+
+logger = logging.getLogger(__name__)
+
+_U64 = (1 << 64) - 1
+
+
+def _cell_ids(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """Vectorised tiles.tile_fraction: the CELL_ZOOM tile of each point as x * n + y."""
+
+    n = 1 << CELL_ZOOM
+    lat_rad = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    fx = np.clip((lon + 180.0) / 360.0 * n, 0, n - 1)
+    fy = np.clip((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n, 0, n - 1)
+    return fx.astype(np.int64) * n + fy.astype(np.int64)
+
+
+class AmenityIndex:
+    """Column-oriented snapshot of the amenities table, grouped by grid cell.
+
+    Rows are sorted by CELL_ZOOM tile, so the amenities of a set of tiles are
+    found with a binary search per tile. Props stay Python objects since they
+    are only touched for returned rows.
+    """
+
+    def __init__(
+        self,
+        ids_hi: np.ndarray,
+        ids_lo: np.ndarray,
+        lon: np.ndarray,
+        lat: np.ndarray,
+        codes: np.ndarray,
+        categories: list[str],
+        props: list[Any],
+    ) -> None:
+        cells = _cell_ids(lon, lat)
+        order = np.argsort(cells, kind="stable")
+        self.cells = cells[order]
+        self.ids_hi = ids_hi[order]
+        self.ids_lo = ids_lo[order]
+        self.lon = lon[order]
+        self.lat = lat[order]
+        self.codes = codes[order]
+        self.categories = categories
+        self.props = [props[i] for i in order]
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: list[tuple[UUID, str, Any, float, float]],
+        categories: list[str] | None = None,
+    ) -> AmenityIndex:
+        categories = list(categories or [])
+        lookup = {name: code for code, name in enumerate(categories)}
+        codes = []
+        for _, category, _, _, _ in rows:
+            if category not in lookup:
+                lookup[category] = len(categories)
+                categories.append(category)
+            codes.append(lookup[category])
+        ints = [row[0].int for row in rows]
+        return cls(
+            np.array([value >> 64 for value in ints], dtype=np.uint64),
+            np.array([value & _U64 for value in ints], dtype=np.uint64),
+            np.array([row[3] for row in rows], dtype=np.float64),
+            np.array([row[4] for row in rows], dtype=np.float64),
+            np.array(codes, dtype=np.int32),
+            categories,
+            [row[2] for row in rows],
+        )
+
+    def patched(self, cells: np.ndarray, rows: list[tuple[UUID, str, Any, float, float]]) -> AmenityIndex:
+        """Return a copy with the given tiles replaced by freshly loaded rows."""
+
+        fresh = AmenityIndex.from_rows(rows, self.categories)
+        # Loaded rows may include edge points owned by an unchanged neighbour.
+        fresh_keep = np.isin(fresh.cells, cells)
+        keep = ~np.isin(self.cells, cells)
+        return AmenityIndex(
+            np.concatenate((self.ids_hi[keep], fresh.ids_hi[fresh_keep])),
+            np.concatenate((self.ids_lo[keep], fresh.ids_lo[fresh_keep])),
+            np.concatenate((self.lon[keep], fresh.lon[fresh_keep])),
+            np.concatenate((self.lat[keep], fresh.lat[fresh_keep])),
+            np.concatenate((self.codes[keep], fresh.codes[fresh_keep])),
+            fresh.categories,
+            [p for p, k in zip(self.props, keep) if k] + [p for p, k in zip(fresh.props, fresh_keep) if k],
+        )
+
+    def candidates(self, cells: np.ndarray) -> np.ndarray:
+        """Row positions of every amenity in the given tiles."""
+
+        starts = np.searchsorted(self.cells, cells, side="left")
+        ends = np.searchsorted(self.cells, cells, side="right")
+        ranges = [np.arange(s, e) for s, e in zip(starts, ends) if e > s]
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def category_codes(self, categories: list[str]) -> np.ndarray:
+        return np.array([self.categories.index(c) for c in categories if c in self.categories], dtype=np.int32)
+
+
+_index: Optional[AmenityIndex] = None
+# (dataset version, last change id) the loaded index reflects.
+_loaded_at: tuple[int, int] = (-1, -1)
+_lock = asyncio.Lock()
+
+
+def _row(record: Any) -> tuple[UUID, str, Any, float, float]:
+    return (record["id"], record["category"], record["props"], record["lon"], record["lat"])
+
+
+async def _load(db: Database) -> AmenityIndex:
+    rows = [_row(record) async for record in db.iterate(AMENITY_INDEX_SQL, prefetch=10_000)]
+    return await asyncio.to_thread(AmenityIndex.from_rows, rows)
+
+
+async def get_index(db: Database) -> AmenityIndex:
+    """Return the index, bringing it up to date with the dataset first.
+
+    A new dataset version reloads everything; tile-level changes reload just
+    the affected tiles. Arrays are built in a worker thread, so only callers
+    of this function wait for a reload, not the whole event loop. Callers do
+    wait rather than get the previous index: their results are cached under
+    the new dataset state.
+    """
+
+    global _index, _loaded_at
+    state = (dataset.current_version(dataset.AMENITIES), dataset.last_change_id())
+    if _index is not None and _loaded_at == state:
+        return _index
+    async with _lock:
+        state = (dataset.current_version(dataset.AMENITIES), dataset.last_change_id())
+        if _index is not None and _loaded_at == state:
+            return _index
+        changed = None
+        if _index is not None and _loaded_at[0] == state[0]:
+            changed = dataset.changed_tiles(CELL_ZOOM, _loaded_at[1])
+        if changed is None:
+            _index = await _load(db)
+            logger.info("loaded %d amenities into the memory index", len(_index))
+        elif changed:
+            records = await db.fetch(
+                CELL_AMENITIES_SQL, CELL_ZOOM, [x for x, _ in changed], [y for _, y in changed]
+            )
+            # Points on a shared tile edge come back once per tile.
+            rows = list({record["id"]: _row(record) for record in records}.values())
+            n = 1 << CELL_ZOOM
+            cells = np.array([x * n + y for x, y in changed], dtype=np.int64)
+            _index = await asyncio.to_thread(_index.patched, cells, rows)
+        _loaded_at = state
+        return _index
+
+
+async def search_memory(
+    db: Database,
+    route: dict[str, Any],
+    radius_m: float,
+    categories: list[str] | None,
+    order: str,
+    after: tuple[float, UUID] | None,
+    limit: int | None,
+) -> list[dict[str, Any]]:
+    """Answer a route search from the in-process index. Rows have the same
+    fields as the SQL engines.
+    """
+
+    index = await get_index(db)
+    coordinates = route["geometry"]["coordinates"]
+    n = 1 << CELL_ZOOM
+    cells = np.array([x * n + y for x, y in covering_cells(coordinates, radius_m)], dtype=np.int64)
+    rows = index.candidates(cells)
+    if categories:
+        rows = rows[np.isin(index.codes[rows], index.category_codes(categories))]
+    dist, along = geo.locate(index.lon[rows], index.lat[rows], geo.as_line(coordinates), radius_m)
+    keep = dist <= radius_m
+    rows, dist, along = rows[keep], dist[keep], along[keep]
+
+    value = along if order == "along" else dist
+    hi, lo = index.ids_hi[rows], index.ids_lo[rows]
+    if after is not None:
+        after_value, after_id = after
+        after_hi, after_lo = np.uint64(after_id.int >> 64), np.uint64(after_id.int & _U64)
+        later = (value > after_value) | (
+            (value == after_value) & ((hi > after_hi) | ((hi == after_hi) & (lo > after_lo)))
+        )
+        rows, dist, along, value, hi, lo = rows[later], dist[later], along[later], value[later], hi[later], lo[later]
+    ranked = np.lexsort((lo, hi, value))
+    if limit is not None:
+        ranked = ranked[:limit]
+
+    results = []
+    for i in ranked:
+        row = rows[i]
+        lon, lat = float(index.lon[row]), float(index.lat[row])
+        results.append(
+            {
+                "id": UUID(int=(int(hi[i]) << 64) | int(lo[i])),
+                "category": index.categories[index.codes[row]],
+                "props": index.props[row],
+                "dist_m": float(dist[i]),
+                "along_m": float(along[i]),
+                "geom": Geometry.point(lon, lat),
+            }
+        )
+    return results
@@ -1,29 +1,343 @@
-SEARCH_SQL = """
+# Every search query returns (id, category, props, dist_m, along_m, geom)
+# and shares its leading parameters:
+#   $1 route_id, $2 radius_m, $3 categories (NULL = all), $4 order,
+#   $5/$6 keyset cursor (sort value, id; NULL = first page), $7 limit (NULL = all)
+# along_m is the linear-referenced position along the route in metres. The
+# order ('distance' or 'along') picks the sort value; id breaks ties so the
+# keyset cursor is stable.
+
+# $8 is the corridor radius bucket (>= $2). A missing corridor is buffered and
+# stored in the same statement; if a concurrent search stored it first, the
+# buffer is computed inline for this call only.
+_CORRIDOR_CTES = """existing AS (
+  SELECT geom FROM route_corridors WHERE route_id = $1 AND radius_m = $8
+),
+created AS (
+  INSERT INTO route_corridors (route_id, radius_m, geom, bbox)
+  SELECT r.route_id, $8, c.geom, Box2D(c.geom)
+  FROM routes r
+  CROSS JOIN LATERAL (
+    SELECT ST_Buffer(ST_LineMerge(r.geom)::geography, $8)::geometry AS geom
+  ) AS c
+  WHERE r.route_id = $1 AND NOT EXISTS (SELECT 1 FROM existing)
+  ON CONFLICT (route_id, radius_m) DO NOTHING
+  RETURNING geom
+),
+corridor AS (
+  SELECT geom FROM existing
+  UNION ALL
+  SELECT geom FROM created
+  UNION ALL
+  SELECT ST_Buffer(ST_LineMerge(geom)::geography, $8)::geometry
+  FROM routes
+  WHERE route_id = $1
+    AND NOT EXISTS (SELECT 1 FROM existing)
+    AND NOT EXISTS (SELECT 1 FROM created)
+),
+route AS (
+  SELECT line, line::geography AS g, ST_Length(line::geography) AS length_m
+  FROM (SELECT ST_LineMerge(geom) AS line FROM routes WHERE route_id = $1) AS merged
+)"""
+
+SEARCH_SQL = f"""
+WITH {_CORRIDOR_CTES}
+SELECT id, category, props, dist_m, along_m, geom
+FROM (
+  SELECT a.id,
+         a.category,
+         a.props,
+         ST_Distance(a.geom::geography, r.g) AS dist_m,
+         ST_LineLocatePoint(r.line, a.geom) * r.length_m AS along_m,
+         a.geom
+  FROM amenities a, route r
+  WHERE ST_Intersects(a.geom, (SELECT geom FROM corridor LIMIT 1))
+    AND ($3::text[] IS NULL OR a.category = ANY($3::text[]))
+) AS hits
+WHERE dist_m <= $2
+  AND ($5::float8 IS NULL
+       OR (CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id) > ($5::float8, $6::uuid))
+ORDER BY CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id
+LIMIT $7;
+"""
+
+# Per-category radii in one pass: the corridor is buffered once at the largest
+# radius ($2, bucketed in $8) and each category is trimmed to its own radius.
+# $9 holds the radii aligned with the categories in $3. Every parameter has to
+# be referenced, or PostgreSQL cannot infer its type when preparing.
+CATEGORY_RADII_SEARCH_SQL = f"""
+WITH {_CORRIDOR_CTES},
+wanted AS (
+  SELECT * FROM unnest($3::text[], $9::float8[]) AS w(category, radius_m)
+)
+SELECT id, category, props, dist_m, along_m, geom
+FROM (
+  SELECT a.id,
+         a.category,
+         a.props,
+         w.radius_m,
+         ST_Distance(a.geom::geography, r.g) AS dist_m,
+         ST_LineLocatePoint(r.line, a.geom) * r.length_m AS along_m,
+         a.geom
+  FROM amenities a
+  JOIN wanted w ON w.category = a.category
+  CROSS JOIN route r
+  WHERE ST_Intersects(a.geom, (SELECT geom FROM corridor LIMIT 1))
+) AS hits
+WHERE dist_m <= radius_m
+  AND dist_m <= $2::float8
+  AND ($5::float8 IS NULL
+       OR (CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id) > ($5::float8, $6::uuid))
+ORDER BY CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id
+LIMIT $7;
+"""
+
+# Searches one slice ($9..$10 as line fractions) of a long route against the
+# stored corridor for bucket $8; the API runs several of these concurrently.
+# The slice only narrows the index probe to its bounding box, widened by the
+# bucket radius in degrees (conservatively: a degree is at least 110 km of
+# latitude and 111 km * cos(lat) of longitude). Distance and position are
+# measured against the whole route, so an amenity returned by two
+# neighbouring slices gets identical values.
+SEGMENT_SEARCH_SQL = f"""
+WITH {_CORRIDOR_CTES},
+slice AS (
+  SELECT ST_Expand(
+           box,
+           $8::float8 / (111000.0 * cos(radians(LEAST(89.0,
+             GREATEST(abs(ST_YMin(box)), abs(ST_YMax(box))) + $8::float8 / 110000.0)))),
+           $8::float8 / 110000.0
+         ) AS box
+  FROM (SELECT Box2D(ST_LineSubstring(line, $9, $10)) AS box FROM route) AS part
+)
+SELECT id, category, props, dist_m, along_m, geom
+FROM (
+  SELECT a.id,
+         a.category,
+         a.props,
+         ST_Distance(a.geom::geography, r.g) AS dist_m,
+         ST_LineLocatePoint(r.line, a.geom) * r.length_m AS along_m,
+         a.geom
+  FROM amenities a, route r, slice s
+  WHERE a.geom && s.box
+    AND ST_Intersects(a.geom, (SELECT geom FROM corridor LIMIT 1))
+    AND ($3::text[] IS NULL OR a.category = ANY($3::text[]))
+) AS hits
+WHERE dist_m <= $2
+  AND ($5::float8 IS NULL
+       OR (CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id) > ($5::float8, $6::uuid))
+ORDER BY CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id
+LIMIT $7;
+"""
+
+# "dwithin" engine: geodesic distance filter answered by the amenities_geog_gix
+# expression index, without building a buffer polygon.
+DWITHIN_SEARCH_SQL = """
 WITH route AS (
-  SELECT ST_LineMerge(geom)::geography AS g, name FROM routes WHERE route_id = $1
+  SELECT line, line::geography AS g, ST_Length(line::geography) AS length_m
+  FROM (SELECT ST_LineMerge(geom) AS line FROM routes WHERE route_id = $1) AS merged
+)
+SELECT id, category, props, dist_m, along_m, geom
+FROM (
+  SELECT a.id,
+         a.category,
+         a.props,
+         ST_Distance(a.geom::geography, r.g) AS dist_m,
+         ST_LineLocatePoint(r.line, a.geom) * r.length_m AS along_m,
+         a.geom
+  FROM amenities a, route r
+  WHERE ST_DWithin(a.geom::geography, r.g, $2)
+    AND ($3::text[] IS NULL OR a.category = ANY($3::text[]))
+) AS hits
+WHERE $5::float8 IS NULL
+   OR (CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id) > ($5::float8, $6::uuid)
+ORDER BY CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id
+LIMIT $7;
+"""
+
+# Slice variant of DWITHIN_SEARCH_SQL; $8..$9 are line fractions.
+DWITHIN_SEGMENT_SEARCH_SQL = """
+WITH route AS (
+  SELECT line, line::geography AS g, ST_Length(line::geography) AS length_m,
+         ST_LineSubstring(line, $8, $9)::geography AS chunk
+  FROM (SELECT ST_LineMerge(geom) AS line FROM routes WHERE route_id = $1) AS merged
+)
+SELECT id, category, props, dist_m, along_m, geom
+FROM (
+  SELECT a.id,
+         a.category,
+         a.props,
+         ST_Distance(a.geom::geography, r.g) AS dist_m,
+         ST_LineLocatePoint(r.line, a.geom) * r.length_m AS along_m,
+         a.geom
+  FROM amenities a, route r
+  WHERE ST_DWithin(a.geom::geography, r.chunk, $2)
+    AND ($3::text[] IS NULL OR a.category = ANY($3::text[]))
+) AS hits
+WHERE $5::float8 IS NULL
+   OR (CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id) > ($5::float8, $6::uuid)
+ORDER BY CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id
+LIMIT $7;
+"""
+
+# Windowed search over the persisted route index: $8..$9 is the along-route
+# window in km. Pure btree range scan, no geometry work.
+ROUTE_INDEX_WINDOW_SQL = """
+SELECT id, category, props, dist_m, along_m, geom
+FROM (
+  SELECT a.id,
+         a.category,
+         a.props,
+         i.offset_m AS dist_m,
+         i.along_km * 1000.0 AS along_m,
+         a.geom
+  FROM route_amenity_index i
+  JOIN amenities a ON a.id = i.amenity_id
+  WHERE i.route_id = $1
+    AND i.along_km BETWEEN $8 AND $9
+    AND i.offset_m <= $2
+    AND ($3::text[] IS NULL OR a.category = ANY($3::text[]))
+) AS hits
+WHERE $5::float8 IS NULL
+   OR (CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id) > ($5::float8, $6::uuid)
+ORDER BY CASE WHEN $4::text = 'along' THEN along_m ELSE dist_m END, id
+LIMIT $7;
+"""
+
+ROUTE_INDEX_RADIUS_SQL = "SELECT radius_m FROM route_amenity_index_meta WHERE route_id = $1"
+
+# (Re)indexes every amenity within $2 metres of the route and records the
+# covered radius; the amenities triggers keep it current afterwards.
+ROUTE_INDEX_BUILD_SQL = """
+WITH route AS (
+  SELECT route_id, line, line::geography AS g, ST_Length(line::geography) AS length_m
+  FROM (SELECT route_id, ST_LineMerge(geom) AS line FROM routes WHERE route_id = $1) AS merged
 ),
-buf AS (
-  SELECT ST_Buffer(g, $2)::geometry AS g FROM route
-)
-SELECT a.id,
-       a.category,
-       a.props,
-       ST_Distance(a.geom::geography, (SELECT g FROM route)) AS dist_m,
-       ST_AsGeoJSON(a.geom) AS geojson
-FROM amenities a
-WHERE ST_Intersects(a.geom, (SELECT g FROM buf))
-  AND ($3::text[] IS NULL OR a.category = ANY($3::text[]))
-ORDER BY dist_m
-LIMIT 500;
-"""
-
-ROUTE_GEOJSON_SQL = """
-SELECT route_id,
-       name,
-       ST_AsGeoJSON(geom) AS geojson,
-       encode(ST_AsEWKB(geom), 'hex') AS wkb_hex
+indexed AS (
+  INSERT INTO route_amenity_index (route_id, amenity_id, along_km, offset_m)
+  SELECT r.route_id,
+         a.id,
+         ST_LineLocatePoint(r.line, a.geom) * r.length_m / 1000.0,
+         ST_Distance(a.geom::geography, r.g)
+  FROM route r
+  JOIN amenities a ON ST_DWithin(a.geom::geography, r.g, $2)
+  ON CONFLICT (route_id, amenity_id)
+  DO UPDATE SET along_km = EXCLUDED.along_km, offset_m = EXCLUDED.offset_m
+)
+INSERT INTO route_amenity_index_meta (route_id, radius_m, built_at)
+SELECT route_id, $2, NOW() FROM route
+ON CONFLICT (route_id)
+DO UPDATE SET radius_m = GREATEST(route_amenity_index_meta.radius_m, EXCLUDED.radius_m), built_at = NOW()
+"""
+
+ROUTE_CORRIDORS_SQL = """
+INSERT INTO route_corridors (route_id, radius_m, geom, bbox)
+SELECT r.route_id, radii.radius_m, c.geom, Box2D(c.geom)
+FROM routes r
+CROSS JOIN unnest($2::int[]) AS radii(radius_m)
+CROSS JOIN LATERAL (
+  SELECT ST_Buffer(ST_LineMerge(r.geom)::geography, radii.radius_m)::geometry AS geom
+) AS c
+WHERE r.route_id = $1
+  AND NOT EXISTS (
+    SELECT 1 FROM route_corridors rc WHERE rc.route_id = r.route_id AND rc.radius_m = radii.radius_m
+  )
+ON CONFLICT (route_id, radius_m) DO NOTHING
+"""
+
+ROUTE_SQL = """
+SELECT route_id, name, geom, ST_Length(geom::geography) AS length_m
 FROM routes
 WHERE route_id = $1
 """
 
-GEOJSON_TO_WKT_SQL = "SELECT ST_AsText(ST_GeomFromGeoJSON($1))"
+AMENITY_INDEX_SQL = "SELECT id, category, props, ST_X(geom) AS lon, ST_Y(geom) AS lat FROM amenities"
+
+AMENITIES_BY_ID_SQL = """
+SELECT id, category, props, geom
+FROM amenities
+WHERE id = ANY($1::uuid[])
+"""
+
+# Every amenity inside the zoom-$1 tiles given as parallel x ($2) / y ($3)
+# arrays; points on a shared edge are returned for both tiles.
+CELL_AMENITIES_SQL = """
+SELECT c.x, c.y, a.id, a.category, a.props, ST_X(a.geom) AS lon, ST_Y(a.geom) AS lat
+FROM unnest($2::int[], $3::int[]) AS c(x, y)
+JOIN amenities a ON a.geom_3857 && ST_TileEnvelope($1, c.x, c.y)
+"""
+
+ROUTES_SQL = """
+SELECT route_id, name, geom, ST_Length(geom::geography) AS length_m
+FROM routes
+WHERE route_id = ANY($1::uuid[])
+"""
+
+INSERT_ROUTE_SQL = """
+INSERT INTO routes (route_id, name, geom, created_at)
+VALUES ($1, $2, $3, NOW())
+RETURNING ST_Length(geom::geography) AS length_m
+"""
+
+MVT_SQL = """
+WITH bounds AS (
+  SELECT ST_TileEnvelope($1, $2, $3) AS geom_3857
+)
+SELECT ST_AsMVT(tile, 'amenities', 4096, 'geom') FROM (
+  SELECT
+    a.id,
+    a.category,
+    a.props,
+    ST_AsMVTGeom(a.geom_3857, bounds.geom_3857, 4096, 64, true) AS geom
+  FROM amenities a, bounds
+  WHERE ST_Intersects(a.geom_3857, bounds.geom_3857)
+    AND ($4::text[] IS NULL OR a.category = ANY($4::text[]))
+) AS tile;
+"""
+
+# Renders a (2^$2 x 2^$2) block of zoom-$1 tiles whose parent at zoom $1 - $2 is
+# ($3, $4): one index scan over the block envelope, then one ST_AsMVT per tile.
+METATILE_MVT_SQL = """
+WITH block AS (
+  SELECT ST_TileEnvelope($1::int - $2::int, $3::int, $4::int) AS geom_3857
+),
+candidates AS MATERIALIZED (
+  SELECT
+    a.id,
+    a.category,
+    a.props,
+    a.geom_3857
+  FROM amenities a, block
+  WHERE ST_Intersects(a.geom_3857, block.geom_3857)
+    AND ($5::text[] IS NULL OR a.category = ANY($5::text[]))
+),
+grid AS (
+  SELECT tx, ty, ST_TileEnvelope($1::int, tx, ty) AS geom_3857
+  FROM generate_series($3::int << $2::int, (($3::int + 1) << $2::int) - 1) AS tx,
+       generate_series($4::int << $2::int, (($4::int + 1) << $2::int) - 1) AS ty
+)
+SELECT
+  grid.tx AS x,
+  grid.ty AS y,
+  (
+    SELECT ST_AsMVT(tile, 'amenities', 4096, 'geom') FROM (
+      SELECT
+        c.id,
+        c.category,
+        c.props,
+        ST_AsMVTGeom(c.geom_3857, grid.geom_3857, 4096, 64, true) AS geom
+      FROM candidates c
+      WHERE ST_Intersects(c.geom_3857, grid.geom_3857)
+    ) AS tile
+  ) AS mvt
+FROM grid;
+"""
+
+# Latest amenity change id; falls back to the sequence once every logged
+# change has been pruned, matching dataset.tracked_since().
+CHANGE_WATERMARK_SQL = """
+SELECT COALESCE(
+    (SELECT max(change_id) FROM amenity_changes),
+    pg_sequence_last_value(pg_get_serial_sequence('amenity_changes', 'change_id')),
+    0
+)
+"""
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Any, Optional
+from uuid import UUID
+
+import cache
+import tiles
+from dataset import REGION_CELL_ZOOM
+from db import Database
+from geometry import Geometry, encode_ewkb
+from queries import ROUTE_SQL, ROUTES_SQL
+
+ROUTE_META_TTL = 60 * 60 * 24
+# Bump whenever the shape of the cached metadata changes.
+ROUTE_META_VERSION = 4
+
+
+def _cache_key(route_id: UUID | str) -> str:
+    return f"route:meta:v{ROUTE_META_VERSION}:{route_id}"
+
+
+def build_route_meta(
+    route_id: UUID | str,
+    name: str,
+    geom: Geometry,
+    length_m: float,
+) -> dict[str, Any]:
+    """Assemble the cached route metadata from a ROUTE_SQL-shaped row."""
+
+    geometry = geom.geojson()
+    coordinates = geometry["coordinates"]
+    lons = geom.coords[0::2]
+    lats = geom.coords[1::2]
+    return {
+        "route_id": str(route_id),
+        "name": name,
+        "geometry": geometry,
+        "digest": hashlib.sha1(encode_ewkb(geom)).hexdigest(),
+        "length_m": float(length_m),
+        "bbox": [min(lons), min(lats), max(lons), max(lats)],
+        # Coarse grid cells used to scope cache invalidation to nearby edits.
+        "cells": tiles.cells_along_line(coordinates, REGION_CELL_ZOOM),
+    }
+
+
+async def put_route_meta(meta: dict[str, Any]) -> None:
+    await cache.set_json(_cache_key(meta["route_id"]), meta, ROUTE_META_TTL)
+
+
+async def get_route_meta(db: Database, route_id: UUID) -> Optional[dict[str, Any]]:
+    """Return route metadata, consulting the cache tiers before PostGIS."""
+
+    meta = await cache.get_json(_cache_key(route_id))
+    if meta is not None:
+        return meta
+
+    record = await db.fetchrow(ROUTE_SQL, route_id)
+    if record is None:
+        return None
+    meta = build_route_meta(route_id, record["name"], record["geom"], record["length_m"])
+    await put_route_meta(meta)
+    return meta
+
+
+async def get_route_metas(db: Database, route_ids: list[UUID]) -> dict[str, dict[str, Any]]:
+    """Return metadata for several routes keyed by route id; unknown ids are omitted.
+
+    Cache hits are resolved with one MGET, the misses with one query and one
+    pipelined write-back.
+    """
+
+    unique_ids = list(dict.fromkeys(route_ids))
+    cached = await cache.get_many_json([_cache_key(route_id) for route_id in unique_ids])
+    metas = {str(route_id): meta for route_id, meta in zip(unique_ids, cached) if meta is not None}
+    missing = [route_id for route_id in unique_ids if str(route_id) not in metas]
+    if missing:
+        fetched = {}
+        for record in await db.fetch(ROUTES_SQL, missing):
+            meta = build_route_meta(record["route_id"], record["name"], record["geom"], record["length_m"])
+            fetched[_cache_key(meta["route_id"])] = meta
+            metas[meta["route_id"]] = meta
+        await cache.set_many_json(fetched, ROUTE_META_TTL)
+    return metas
+
+
+async def invalidate_route_meta(route_id: UUID) -> None:
+    """Drop a route from the cache; call this from any path that mutates ``routes``."""
+
+    await cache.delete(_cache_key(route_id))
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import asyncio
+import math
+from typing import Any, AsyncIterator, Iterable
+from uuid import UUID
+
+import asyncpg
+
+import cell_search
+import memory_index
+import route_cache
+from config import settings
+from db import Database
+from queries import (
+    CATEGORY_RADII_SEARCH_SQL,
+    DWITHIN_SEARCH_SQL,
+    DWITHIN_SEGMENT_SEARCH_SQL,
+    ROUTE_CORRIDORS_SQL,
+    ROUTE_INDEX_BUILD_SQL,
+    ROUTE_INDEX_RADIUS_SQL,
+    ROUTE_INDEX_WINDOW_SQL,
+    SEARCH_SQL,
+    SEGMENT_SEARCH_SQL,
+)
+
+# Corridors are stored per radius bucket; a search is served from the
+# smallest bucket that covers its radius and trimmed by exact distance.
+CORRIDOR_BUCKET_M = 50
+# Largest page a single search returns; streaming responses are unbounded.
+SEARCH_LIMIT = 500
+
+# "corridor" intersects a stored route buffer; "dwithin" uses ST_DWithin on
+# geography against an expression index; "cells" assembles cached per-tile
+# amenities and measures distances in process; "memory" answers from an
+# in-process copy of the amenities table. See bench_search.py.
+SEARCH_ENGINES = ("corridor", "dwithin", "cells", "memory")
+# Engines that run in the API process and fall back to "corridor" elsewhere.
+IN_PROCESS_ENGINES = {"cells": cell_search.search_cells, "memory": memory_index.search_memory}
+# "distance" sorts by offset from the route, "along" by position along it.
+SEARCH_ORDERS = ("distance", "along")
+
+
+def corridor_radius(radius_m: float) -> int:
+    """Round a search radius up to the corridor bucket it is served from."""
+
+    return max(CORRIDOR_BUCKET_M, math.ceil(radius_m / CORRIDOR_BUCKET_M) * CORRIDOR_BUCKET_M)
+
+
+def segment_count(length_m: float | None) -> int:
+    """Return how many slices a route of ``length_m`` is searched in."""
+
+    if length_m is None or length_m < settings.search_segment_min_route_m:
+        return 1
+    return max(1, math.ceil(length_m / settings.search_segment_length_m))
+
+
+def sort_value(row: Any, order: str) -> float:
+    """Return the value a row is ordered by (before its id) for ``order``."""
+
+    return row["along_m"] if order == "along" else row["dist_m"]
+
+
+def _common_args(
+    route_id: UUID,
+    radius_m: float,
+    categories: list[str] | None,
+    order: str,
+    after: tuple[float, UUID] | None,
+    limit: int | None,
+) -> list[Any]:
+    after_value, after_id = after if after is not None else (None, None)
+    return [route_id, radius_m, categories, order, after_value, after_id, limit]
+
+
+def _category_radii_args(
+    route_id: UUID,
+    radii: dict[str, float],
+    order: str,
+    after: tuple[float, UUID] | None,
+    limit: int | None,
+) -> list[Any]:
+    categories = sorted(radii)
+    max_radius = max(radii.values())
+    args = _common_args(route_id, max_radius, categories, order, after, limit)
+    return [*args, corridor_radius(max_radius), [float(radii[c]) for c in categories]]
+
+
+def _single_query(
+    engine: str,
+    radius_m: float,
+    window_km: tuple[float, float] | None,
+) -> tuple[str, list[Any]]:
+    if window_km is not None:
+        return ROUTE_INDEX_WINDOW_SQL, list(window_km)
+    if engine == "dwithin":
+        return DWITHIN_SEARCH_SQL, []
+    return SEARCH_SQL, [corridor_radius(radius_m)]
+
+
+def _check_engine(engine: str | None) -> str:
+    engine = engine or settings.search_engine
+    if engine not in SEARCH_ENGINES:
+        raise ValueError(f"Unknown search engine: {engine}")
+    return engine
+
+
+async def _search_segments(
+    db: Database,
+    args: list[Any],
+    segments: int,
+    engine: str,
+    order: str,
+    limit: int,
+) -> list[asyncpg.Record]:
+    semaphore = asyncio.Semaphore(settings.search_segment_concurrency)
+    if engine == "dwithin":
+        query, extra = DWITHIN_SEGMENT_SEARCH_SQL, []
+    else:
+        # Store the corridor up front so the slices share it instead of each
+        # buffering the whole route when they race to create it.
+        bucket = corridor_radius(args[1])
+        await db.execute(ROUTE_CORRIDORS_SQL, args[0], [bucket])
+        query, extra = SEGMENT_SEARCH_SQL, [bucket]
+
+    async def run(index: int) -> list[asyncpg.Record]:
+        async with semaphore:
+            return await db.fetch(query, *args, *extra, index / segments, (index + 1) / segments)
+
+    # Slices overlap near their boundaries; duplicates carry identical values
+    # because every slice measures against the whole route.
+    merged: dict[UUID, asyncpg.Record] = {}
+    for rows in await asyncio.gather(*(run(i) for i in range(segments))):
+        for row in rows:
+            merged.setdefault(row["id"], row)
+    return sorted(merged.values(), key=lambda row: (sort_value(row, order), row["id"]))[:limit]
+
+
+async def search_amenities(
+    conn: Database | asyncpg.Connection,
+    route_id: UUID,
+    radius_m: float,
+    categories: list[str] | None,
+    length_m: float | None = None,
+    engine: str | None = None,
+    order: str = "distance",
+    after: tuple[float, UUID] | None = None,
+    limit: int = SEARCH_LIMIT,
+) -> list[asyncpg.Record]:
+    """Return one page of amenities within ``radius_m`` of a route.
+
+    Pages are ordered by ``order`` then id; ``after`` is the (sort value, id)
+    of the last row of the previous page. Long routes are split into slices
+    searched concurrently on separate pool connections; a bare connection (as
+    used by the worker) always runs a single SQL query, with the in-process
+    engines falling back to "corridor". ``engine`` defaults to
+    ``settings.search_engine``.
+    """
+
+    engine = _check_engine(engine)
+    if engine in IN_PROCESS_ENGINES and isinstance(conn, Database):
+        route = await route_cache.get_route_meta(conn, route_id)
+        if route is None:
+            return []
+        return await IN_PROCESS_ENGINES[engine](conn, route, radius_m, categories, order, after, limit)
+    args = _common_args(route_id, radius_m, categories, order, after, limit)
+    segments = segment_count(length_m)
+    if segments > 1 and isinstance(conn, Database):
+        return await _search_segments(conn, args, segments, engine, order, limit)
+    query, extra = _single_query(engine, radius_m, None)
+    return await conn.fetch(query, *args, *extra)
+
+
+async def search_category_radii(
+    conn: Database | asyncpg.Connection,
+    route_id: UUID,
+    radii: dict[str, float],
+    order: str = "distance",
+    after: tuple[float, UUID] | None = None,
+    limit: int = SEARCH_LIMIT,
+) -> list[asyncpg.Record]:
+    """Return one page of amenities, each category within its own radius.
+
+    The route is buffered once at the largest radius in ``radii``. This
+    always runs the corridor SQL, whatever SEARCH_ENGINE says, and long
+    routes are not sliced.
+    """
+
+    args = _category_radii_args(route_id, radii, order, after, limit)
+    return await conn.fetch(CATEGORY_RADII_SEARCH_SQL, *args)
+
+
+async def iter_amenities(
+    db: Database,
+    route_id: UUID,
+    radius_m: float,
+    categories: list[str] | None,
+    engine: str | None = None,
+    order: str = "distance",
+    after: tuple[float, UUID] | None = None,
+    window_km: tuple[float, float] | None = None,
+    radii: dict[str, float] | None = None,
+) -> AsyncIterator[asyncpg.Record]:
+    """Yield every matching amenity from a server-side cursor.
+
+    Memory stays bounded by the cursor prefetch regardless of how many rows
+    match, so there is no row cap and no slicing; the in-process engines
+    stream from the corridor query instead. ``radii`` switches to the
+    per-category search (corridor SQL only) and overrides ``radius_m`` and
+    ``categories``.
+    """
+
+    if radii:
+        args = _category_radii_args(route_id, radii, order, after, None)
+        async for row in db.iterate(CATEGORY_RADII_SEARCH_SQL, *args):
+            yield row
+        return
+    engine = _check_engine(engine)
+    if window_km is not None:
+        await ensure_route_index(db, route_id, radius_m)
+    args = _common_args(route_id, radius_m, categories, order, after, None)
+    query, extra = _single_query(engine, radius_m, window_km)
+    async for row in db.iterate(query, *args, *extra):
+        yield row
+
+
+async def ensure_route_index(db: Database, route_id: UUID, radius_m: float) -> None:
+    """Build the linear-referencing index for a route if it does not cover ``radius_m``."""
+
+    indexed_radius = await db.fetchval(ROUTE_INDEX_RADIUS_SQL, route_id)
+    if indexed_radius is None or indexed_radius < radius_m:
+        await db.execute(ROUTE_INDEX_BUILD_SQL, route_id, max(radius_m, settings.route_index_radius_m))
+
+
+async def search_window(
+    db: Database,
+    route_id: UUID,
+    radius_m: float,
+    categories: list[str] | None,
+    from_km: float,
+    to_km: float,
+    order: str = "along",
+    after: tuple[float, UUID] | None = None,
+    limit: int = SEARCH_LIMIT,
+) -> list[asyncpg.Record]:
+    """Return one page of amenities between ``from_km`` and ``to_km`` along the route.
+
+    Served from route_amenity_index, which is built on first use.
+    """
+
+    await ensure_route_index(db, route_id, radius_m)
+    args = _common_args(route_id, radius_m, categories, order, after, limit)
+    return await db.fetch(ROUTE_INDEX_WINDOW_SQL, *args, from_km, to_km)
+
+
+async def precompute_corridors(
+    db: Database,
+    route_id: UUID,
+    radii: Iterable[float] | None = None,
+) -> None:
+    """Buffer a new route for the commonly searched radii ahead of time."""
+
+    if radii is None:
+        radii = settings.corridor_precompute_radii
+    buckets = sorted({corridor_radius(r) for r in radii})
+    if buckets:
+        await db.execute(ROUTE_CORRIDORS_SQL, route_id, buckets)
@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import hashlib
+import math
+from typing import Any, Optional
+
+import orjson
+
+import cache
+import dataset
+import search
+
+# Complete first pages remembered per route geometry as candidates for
+# answering narrower searches without PostGIS.
+MAX_VARIANTS = 64
+# Cache lookups spent per miss looking for a wider result.
+MAX_DERIVE_LOOKUPS = 4
+
+_stats = {"derived": 0}
+
+
+def make_search_cache_key(
+    route: dict[str, Any],
+    radius_m: float,
+    filters: list[str] | None,
+    order: str = "distance",
+    window_km: tuple[float, float] | None = None,
+    cursor: str | None = None,
+    limit: int = search.SEARCH_LIMIT,
+    radii: dict[str, float] | None = None,
+) -> str:
+    _, south, _, north = route["bbox"]
+    payload = {
+        "dataset": dataset.current_version(dataset.AMENITIES),
+        "region": dataset.region_generation(route["cells"], radius_m, max(abs(south), abs(north))),
+        "route": route["digest"],
+        "radius": radius_m,
+        "filters": sorted(filters) if filters else [],
+        "order": order,
+        "window": list(window_km) if window_km else None,
+        "cursor": cursor,
+        "limit": limit,
+        "radii": sorted(radii.items()) if radii else None,
+    }
+    digest = hashlib.sha1(orjson.dumps(payload)).hexdigest()
+    return f"q:{digest}"
+
+
+def _index_key(route: dict[str, Any]) -> str:
+    return f"q:variants:{route['digest']}"
+
+
+async def remember(
+    route: dict[str, Any],
+    radius_m: float,
+    filters: list[str] | None,
+    order: str,
+    window_km: tuple[float, float] | None,
+    limit: int,
+    ttl: int,
+) -> None:
+    """Record a cached first page that holds every match for its parameters."""
+
+    member = orjson.dumps(
+        [radius_m, sorted(filters) if filters else [], order, list(window_km) if window_km else None, limit]
+    )
+    await cache.index_add(_index_key(route), member, ttl, MAX_VARIANTS)
+
+
+def _covers(
+    variant: list[Any],
+    radius_m: float,
+    filters: list[str] | None,
+    window_km: tuple[float, float] | None,
+) -> bool:
+    cached_radius, cached_filters, _, cached_window, _ = variant
+    if cached_radius < radius_m:
+        return False
+    if cached_filters and not (filters and set(filters) <= set(cached_filters)):
+        return False
+    if cached_window is not None:
+        if window_km is None or not cached_window[0] <= window_km[0] <= window_km[1] <= cached_window[1]:
+            return False
+    return True
+
+
+def _sort_key(item: dict[str, Any], order: str) -> tuple[float, str]:
+    # Mirrors the SQL ordering: sort value, then id (UUID text sorts like its bytes).
+    value = item["along_km"] if order == "along" else item["distance_m"]
+    return (value if value is not None else math.inf, item["id"])
+
+
+async def derive(
+    route: dict[str, Any],
+    radius_m: float,
+    filters: list[str] | None,
+    order: str,
+    window_km: tuple[float, float] | None,
+    limit: int,
+) -> Optional[list[dict[str, Any]]]:
+    """Answer a first page by filtering a cached result with a wider radius,
+    a superset of categories and a covering window.
+
+    Returns None when no usable wider result is cached or when the narrowed
+    result would not fit in a single page.
+    """
+
+    members = await cache.index_members(_index_key(route))
+    variants = [orjson.loads(member) for member in members]
+    candidates = sorted(
+        (v for v in variants if _covers(v, radius_m, filters, window_km)),
+        key=lambda v: (v[0], len(v[1]) or math.inf),
+    )
+    wanted = set(filters) if filters else None
+    for cached_radius, cached_filters, cached_order, cached_window, cached_limit in candidates[:MAX_DERIVE_LOOKUPS]:
+        key = make_search_cache_key(
+            route,
+            cached_radius,
+            cached_filters,
+            cached_order,
+            tuple(cached_window) if cached_window else None,
+            None,
+            cached_limit,
+        )
+        payload = await cache.get_json(key)
+        if payload is None or payload.get("next_cursor") is not None:
+            continue
+        items = [
+            item
+            for item in payload["items"]
+            if item["distance_m"] is not None
+            and item["distance_m"] <= radius_m
+            and (wanted is None or item["category"] in wanted)
+            and (
+                window_km is None
+                or (item["along_km"] is not None and window_km[0] <= item["along_km"] <= window_km[1])
+            )
+        ]
+        if len(items) > limit:
+            return None
+        items.sort(key=lambda item: _sort_key(item, order))
+        _stats["derived"] += 1
+        return items
+    return None
+
+
+def stats() -> dict[str, Any]:
+    return dict(_stats)
@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import os
 import time
 
 import httpx
 
+import geo
+
 API_BASE = os.environ.get("SMOKE_API_BASE", "http://localhost:8000")
 SEED_ROUTE = "11111111-1111-1111-1111-111111111111"
+# geo.locate uses a sphere and a local projection; PostGIS uses the spheroid.
+KERNEL_TOLERANCE_M = 1.0
+KERNEL_TOLERANCE_RATIO = 0.005
 
 
 def log(message: str) -> None:
@@ -72,6 +78,23 @@ async def run_smoke() -> None:
         if second_duration > 0.5:
             raise RuntimeError("cached search slower than 500 ms")
 
+        log("checking distance kernel against PostGIS")
+        # NDJSON is always served by SQL, whatever SEARCH_ENGINE is set to.
+        resp = await client.get("/search", params={**params, "format": "ndjson"})
+        resp.raise_for_status()
+        features = [json.loads(line) for line in resp.text.splitlines() if line]
+        line = geo.as_line(data["route"]["geometry"]["coordinates"])
+        dists, _ = geo.locate(
+            [f["geometry"]["coordinates"][0] for f in features],
+            [f["geometry"]["coordinates"][1] for f in features],
+            line,
+        )
+        worst = max(abs(d - f["distance_m"]) for d, f in zip(dists.tolist(), features))
+        for d, f in zip(dists.tolist(), features):
+            if abs(d - f["distance_m"]) > KERNEL_TOLERANCE_M + KERNEL_TOLERANCE_RATIO * f["distance_m"]:
+                raise RuntimeError(f"kernel distance {d:.2f} m vs PostGIS {f['distance_m']:.2f} m for {f['id']}")
+        log(f"kernel matches ST_Distance for {len(features)} amenities (max error {worst:.2f} m)")
+
         log("requesting GPX export")
         export_payload = {
             "route_id": SEED_ROUTE,
@@ -96,6 +119,16 @@ async def run_smoke() -> None:
         if len(tile_resp.content) == 0:
             raise RuntimeError("empty tile data")
 
+        # A category nobody has makes the cache key unique and skips the
+        # archive, so this tile is rendered through the metatile query.
+        log("requesting uncached MVT tile")
+        miss_resp = await client.get(
+            "/mvt/amenities/14/8801/5371", params={"filters": f"cafe,water,smoke-{time.time_ns()}"}
+        )
+        miss_resp.raise_for_status()
+        if len(miss_resp.content) == 0:
+            raise RuntimeError("empty tile data on cache miss")
+
         log("smoke tests passed")
 
 
@@ -11,8 +11,206 @@ CREATE TABLE IF NOT EXISTS amenities (
     id UUID PRIMARY KEY,
     category TEXT NOT NULL,
     props JSONB NOT NULL DEFAULT '{}'::jsonb,
-    geom geometry(Point, 4326) NOT NULL
+    geom geometry(Point, 4326) NOT NULL,
+    -- Web Mercator copy used by tile rendering so it can hit its own index.
+    geom_3857 geometry(Point, 3857) GENERATED ALWAYS AS (ST_Transform(geom, 3857)) STORED
 );
 
+-- Upgrade path for databases created before geom_3857 existed.
+ALTER TABLE amenities
+    ADD COLUMN IF NOT EXISTS geom_3857 geometry(Point, 3857)
+    GENERATED ALWAYS AS (ST_Transform(geom, 3857)) STORED;
+
 CREATE INDEX IF NOT EXISTS amenities_geom_gix ON amenities USING GIST (geom);
+CREATE INDEX IF NOT EXISTS amenities_geom_3857_gix ON amenities USING GIST (geom_3857);
+-- Serves ST_DWithin(geom::geography, ...) in the "dwithin" search engine.
+CREATE INDEX IF NOT EXISTS amenities_geog_gix ON amenities USING GIST ((geom::geography));
 CREATE INDEX IF NOT EXISTS amenities_category_idx ON amenities (category);
+
+-- Monotonic dataset versions folded into API cache keys. Bumping a version
+-- makes every cached search and tile for that dataset unreachable.
+CREATE TABLE IF NOT EXISTS dataset_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO dataset_versions (name) VALUES ('amenities') ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_dataset_version(dataset TEXT) RETURNS BIGINT AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE dataset_versions
+    SET version = version + 1
+    WHERE name = dataset
+    RETURNING version INTO new_version;
+    PERFORM pg_notify('dataset_version', dataset || ':' || new_version);
+    RETURN new_version;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Locations touched by small amenity edits. API processes turn these into
+-- per-tile and per-region generations so only nearby cache entries go stale.
+CREATE TABLE IF NOT EXISTS amenity_changes (
+    change_id BIGSERIAL PRIMARY KEY,
+    geom geometry(Point, 4326) NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS amenity_changes_changed_at_idx ON amenity_changes (changed_at);
+
+-- Statements touching more rows than this bump the whole dataset version
+-- instead of logging every location.
+CREATE OR REPLACE FUNCTION record_amenity_changes() RETURNS trigger AS $$
+DECLARE
+    changed BIGINT := 0;
+    last_change BIGINT;
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM bump_dataset_version('amenities');
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT changed + count(*) INTO changed FROM old_rows;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT changed + count(*) INTO changed FROM new_rows;
+    END IF;
+
+    IF changed = 0 THEN
+        RETURN NULL;
+    ELSIF changed > 1000 THEN
+        PERFORM bump_dataset_version('amenities');
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO amenity_changes (geom) SELECT geom FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO amenity_changes (geom) SELECT geom FROM old_rows;
+    ELSE
+        INSERT INTO amenity_changes (geom)
+        SELECT geom FROM old_rows
+        UNION
+        SELECT geom FROM new_rows;
+    END IF;
+
+    SELECT max(change_id) INTO last_change FROM amenity_changes;
+    PERFORM pg_notify('amenity_changes', last_change::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS amenities_version_trg ON amenities;
+DROP TRIGGER IF EXISTS amenities_insert_changes_trg ON amenities;
+DROP TRIGGER IF EXISTS amenities_update_changes_trg ON amenities;
+DROP TRIGGER IF EXISTS amenities_delete_changes_trg ON amenities;
+DROP TRIGGER IF EXISTS amenities_truncate_changes_trg ON amenities;
+DROP FUNCTION IF EXISTS bump_amenities_version();
+
+-- Transition tables only allow a single event per trigger.
+CREATE TRIGGER amenities_insert_changes_trg
+    AFTER INSERT ON amenities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_amenity_changes();
+
+CREATE TRIGGER amenities_update_changes_trg
+    AFTER UPDATE ON amenities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_amenity_changes();
+
+CREATE TRIGGER amenities_delete_changes_trg
+    AFTER DELETE ON amenities
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_amenity_changes();
+
+CREATE TRIGGER amenities_truncate_changes_trg
+    AFTER TRUNCATE ON amenities
+    FOR EACH STATEMENT EXECUTE FUNCTION record_amenity_changes();
+
+-- Geodesic route buffers cached per radius bucket; searches probe the
+-- amenities index with these instead of re-buffering the route.
+CREATE TABLE IF NOT EXISTS route_corridors (
+    route_id UUID NOT NULL REFERENCES routes (route_id) ON DELETE CASCADE,
+    radius_m INTEGER NOT NULL,
+    geom geometry(Geometry, 4326) NOT NULL,
+    bbox box2d NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (route_id, radius_m)
+);
+
+CREATE INDEX IF NOT EXISTS route_corridors_geom_gix ON route_corridors USING GIST (geom);
+
+CREATE INDEX IF NOT EXISTS routes_geog_gix ON routes USING GIST ((geom::geography));
+
+-- Linear-referencing index of amenities along a route: position (km from the
+-- start) and offset (metres from the line) for everything within radius_m.
+CREATE TABLE IF NOT EXISTS route_amenity_index_meta (
+    route_id UUID PRIMARY KEY REFERENCES routes (route_id) ON DELETE CASCADE,
+    radius_m DOUBLE PRECISION NOT NULL,
+    built_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS route_amenity_index (
+    route_id UUID NOT NULL REFERENCES routes (route_id) ON DELETE CASCADE,
+    amenity_id UUID NOT NULL,
+    along_km DOUBLE PRECISION NOT NULL,
+    offset_m DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (route_id, amenity_id)
+);
+
+CREATE INDEX IF NOT EXISTS route_amenity_index_along_idx ON route_amenity_index (route_id, along_km);
+CREATE INDEX IF NOT EXISTS route_amenity_index_amenity_idx ON route_amenity_index (amenity_id);
+
+-- Keeps route_amenity_index exact as amenities change, for every indexed route.
+CREATE OR REPLACE FUNCTION maintain_route_amenity_index() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM route_amenity_index i
+        USING old_rows o
+        WHERE i.amenity_id = o.id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO route_amenity_index (route_id, amenity_id, along_km, offset_m)
+        SELECT r.route_id,
+               n.id,
+               ST_LineLocatePoint(ST_LineMerge(r.geom), n.geom) * ST_Length(r.geom::geography) / 1000.0,
+               ST_Distance(n.geom::geography, r.geom::geography)
+        FROM new_rows n
+        -- Probe routes_geog_gix with the widest indexed radius, then apply
+        -- each route's own radius.
+        JOIN routes r ON ST_DWithin(
+            n.geom::geography,
+            r.geom::geography,
+            (SELECT max(radius_m) FROM route_amenity_index_meta)
+        )
+        JOIN route_amenity_index_meta m ON m.route_id = r.route_id
+        WHERE ST_DWithin(n.geom::geography, r.geom::geography, m.radius_m)
+        ON CONFLICT (route_id, amenity_id)
+        DO UPDATE SET along_km = EXCLUDED.along_km, offset_m = EXCLUDED.offset_m;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS amenities_insert_route_index_trg ON amenities;
+DROP TRIGGER IF EXISTS amenities_update_route_index_trg ON amenities;
+DROP TRIGGER IF EXISTS amenities_delete_route_index_trg ON amenities;
+
+CREATE TRIGGER amenities_insert_route_index_trg
+    AFTER INSERT ON amenities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_route_amenity_index();
+
+CREATE TRIGGER amenities_update_route_index_trg
+    AFTER UPDATE ON amenities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_route_amenity_index();
+
+CREATE TRIGGER amenities_delete_route_index_trg
+    AFTER DELETE ON amenities
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_route_amenity_index();
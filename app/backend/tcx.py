@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+from array import array
+from typing import Optional
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+
+class TCXParseError(ValueError):
+    """Raised when an uploaded TCX document cannot be read."""
+
+
+def _local(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+class TCXTrackReader:
+    """Incrementally extract trackpoint positions from TCX bytes fed in chunks.
+
+    Same interface as gpx.GPXTrackReader. Trackpoints without a Position
+    (pauses, sensor-only samples) are skipped; the name is taken from the
+    first Course, or failing that the first Activity's Id.
+    """
+
+    def __init__(self) -> None:
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._stack: list = []
+        self._lat: Optional[str] = None
+        self._lon: Optional[str] = None
+        self.name: Optional[str] = None
+        self.coords = array("d")
+
+    def feed(self, chunk: bytes) -> None:
+        try:
+            self._parser.feed(chunk)
+        except ParseError as exc:
+            raise TCXParseError(f"Malformed TCX: {exc}") from exc
+        self._drain()
+
+    def close(self) -> tuple[Optional[str], array]:
+        """Finish parsing and return ``(name, coords)``."""
+
+        try:
+            self._parser.close()
+        except ParseError as exc:
+            raise TCXParseError(f"Malformed TCX: {exc}") from exc
+        self._drain()
+        return self.name, self.coords
+
+    def _drain(self) -> None:
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                self._stack.append(elem)
+                continue
+
+            tag = _local(elem.tag)
+            parent = _local(self._stack[-2].tag) if len(self._stack) > 1 else None
+            if tag == "LatitudeDegrees" and parent == "Position":
+                self._lat = elem.text
+            elif tag == "LongitudeDegrees" and parent == "Position":
+                self._lon = elem.text
+            elif tag == "Trackpoint":
+                if self._lat is not None and self._lon is not None:
+                    try:
+                        lon, lat = float(self._lon), float(self._lat)
+                    except ValueError as exc:
+                        raise TCXParseError("Trackpoint with invalid position") from exc
+                    self.coords.append(lon)
+                    self.coords.append(lat)
+                self._lat = self._lon = None
+            elif self.name is None and (tag, parent) in (("Name", "Course"), ("Id", "Activity")):
+                self.name = (elem.text or "").strip() or None
+            self._stack.pop()
+            if self._stack:
+                # The closed element is always its parent's last child.
+                del self._stack[-1][-1]
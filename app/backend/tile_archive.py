@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+import dataset
+
+# Page the archive in through mmap instead of SQLite's own buffer cache.
+ARCHIVE_MMAP_BYTES = 1 << 30
+ARCHIVE_STAT_INTERVAL_S = 5.0
+
+VECTOR_LAYERS = [
+    {
+        "id": "amenities",
+        "fields": {"id": "String", "category": "String", "props": "String"},
+    }
+]
+
+
+class TileArchiveError(Exception):
+    """Raised when an MBTiles archive cannot be written."""
+
+
+def _tms_row(z: int, y: int) -> int:
+    return (1 << z) - 1 - y
+
+
+class MBTilesWriter:
+    """Write gzip-compressed vector tiles into a fresh MBTiles file."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            path.unlink()
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+            """
+        )
+
+    def add_tiles(self, tiles: list[tuple[int, int, int, bytes]]) -> None:
+        # Empty tiles are kept (uncompressed, zero length) so covered areas
+        # never fall back to PostGIS.
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+            [(z, x, _tms_row(z, y), gzip.compress(data, mtime=0) if data else b"") for z, x, y, data in tiles],
+        )
+
+    def finish(self, metadata: dict[str, str]) -> None:
+        self._conn.executemany("INSERT INTO metadata VALUES (?, ?)", list(metadata.items()))
+        self._conn.commit()
+        self._conn.close()
+
+
+def build_metadata(
+    bbox: list[float],
+    min_zoom: int,
+    max_zoom: int,
+    dataset_version: int,
+    change_watermark: int,
+) -> dict[str, str]:
+    return {
+        "name": "amenities",
+        "format": "pbf",
+        "type": "overlay",
+        "bounds": ",".join(str(v) for v in bbox),
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+        "json": json.dumps({"vector_layers": VECTOR_LAYERS}),
+        # Freshness markers checked by the API before serving a tile.
+        "dataset_version": str(dataset_version),
+        "change_watermark": str(change_watermark),
+    }
+
+
+class TileArchive:
+    """Read-only, memory-mapped view of an MBTiles file written by the worker."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.inode = path.stat().st_ino
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+        self._conn.execute(f"PRAGMA mmap_size = {ARCHIVE_MMAP_BYTES}")
+        metadata = dict(self._conn.execute("SELECT name, value FROM metadata").fetchall())
+        self.dataset_version = int(metadata.get("dataset_version", -1))
+        self.change_watermark = int(metadata.get("change_watermark", -1))
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        row = self._conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, _tms_row(z, y)),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_archive: Optional[TileArchive] = None
+_checked_at = 0.0
+
+
+def _current_archive(path: Path) -> Optional[TileArchive]:
+    """Return the open archive, reopening it when the worker replaced the file."""
+
+    global _archive, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < ARCHIVE_STAT_INTERVAL_S:
+        return _archive
+    _checked_at = now
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        inode = None
+    if _archive is not None and _archive.inode == inode:
+        return _archive
+    if _archive is not None:
+        _archive.close()
+        _archive = None
+    if inode is not None:
+        try:
+            _archive = TileArchive(path)
+        except sqlite3.Error:
+            _archive = None
+    return _archive
+
+
+def lookup(path: str, z: int, x: int, y: int) -> Optional[bytes]:
+    """Return the archived (gzip-compressed) tile, or None if it must be rendered.
+
+    Tiles are only served while the archive matches the live dataset version
+    and no amenity inside the tile changed after the archive was rendered.
+    Once changes after the archive's watermark have been pruned from the
+    tracked generations, those edits can no longer be ruled out anywhere, so
+    the archive is bypassed until it is re-rendered.
+    """
+
+    if not path:
+        return None
+    archive = _current_archive(Path(path))
+    if archive is None:
+        return None
+    if archive.dataset_version != dataset.current_version(dataset.AMENITIES):
+        return None
+    if archive.change_watermark < dataset.tracked_since():
+        return None
+    if dataset.tile_generation(z, x, y) > archive.change_watermark:
+        return None
+    return archive.get(z, x, y)
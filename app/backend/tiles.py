@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import math
+from typing import Iterable
+
+# Web Mercator cannot represent the poles; clamp like ST_TileEnvelope does.
+MAX_LATITUDE = 85.0511287798066
+
+
+def tile_fraction(lon: float, lat: float, z: int) -> tuple[float, float]:
+    """Return fractional XYZ tile coordinates of a lon/lat point at zoom ``z``."""
+
+    n = 1 << z
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    lat_rad = math.radians(lat)
+    fx = (lon + 180.0) / 360.0 * n
+    fy = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+    return min(max(fx, 0.0), float(n)), min(max(fy, 0.0), float(n))
+
+
+def tiles_for_point(lon: float, lat: float, z: int) -> list[tuple[int, int]]:
+    """Return every tile whose (closed) envelope contains the point.
+
+    A point exactly on a tile edge intersects both neighbours, matching the
+    ``ST_Intersects`` predicate used when rendering tiles.
+    """
+
+    n = 1 << z
+    fx, fy = tile_fraction(lon, lat, z)
+    xs = {min(int(fx), n - 1)}
+    ys = {min(int(fy), n - 1)}
+    if fx == int(fx) and 0 < fx < n:
+        xs.add(int(fx) - 1)
+    if fy == int(fy) and 0 < fy < n:
+        ys.add(int(fy) - 1)
+    return [(x, y) for x in xs for y in ys]
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Return ``(west, south, east, north)`` in degrees for an XYZ tile."""
+
+    n = 1 << z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def valid_bbox(bbox: list[float]) -> bool:
+    """True for a west < east, south < north bbox within the lon/lat range."""
+
+    west, south, east, north = bbox
+    return -180.0 <= west < east <= 180.0 and -90.0 <= south < north <= 90.0
+
+
+def tile_range(bbox: list[float], z: int) -> tuple[range, range]:
+    """Return the XYZ column and row ranges covering a west, south, east, north bbox."""
+
+    west, south, east, north = bbox
+    n = 1 << z
+    min_x, min_y = tile_fraction(west, north, z)
+    max_x, max_y = tile_fraction(east, south, z)
+    return (
+        range(int(min_x), min(int(max_x), n - 1) + 1),
+        range(int(min_y), min(int(max_y), n - 1) + 1),
+    )
+
+
+def pyramid_tile_count(bbox: list[float], min_zoom: int, max_zoom: int) -> int:
+    """Number of tiles ``tile_range`` yields over a zoom range."""
+
+    total = 0
+    for z in range(min_zoom, max_zoom + 1):
+        xs, ys = tile_range(bbox, z)
+        total += len(xs) * len(ys)
+    return total
+
+
+def tile_size_m(z: int, lat: float) -> float:
+    """Approximate ground width of a tile at the given latitude."""
+
+    return 40075016.686 * math.cos(math.radians(min(abs(lat), MAX_LATITUDE))) / (1 << z)
+
+
+def cells_along_line(coordinates: Iterable[Iterable[float]], z: int) -> list[tuple[int, int]]:
+    """Return the tiles at zoom ``z`` touched by a polyline of ``[lon, lat]`` pairs.
+
+    Segments are sampled at half-tile steps, so a segment never skips a tile
+    without also touching one of its neighbours.
+    """
+
+    n = 1 << z
+    cells: set[tuple[int, int]] = set()
+    previous: tuple[float, float] | None = None
+    for coord in coordinates:
+        current = tile_fraction(coord[0], coord[1], z)
+        if previous is None:
+            points = [current]
+        else:
+            steps = max(1, math.ceil(max(abs(current[0] - previous[0]), abs(current[1] - previous[1])) * 2))
+            points = [
+                (
+                    previous[0] + (current[0] - previous[0]) * i / steps,
+                    previous[1] + (current[1] - previous[1]) * i / steps,
+                )
+                for i in range(1, steps + 1)
+            ]
+        for fx, fy in points:
+            cells.add((min(int(fx), n - 1), min(int(fy), n - 1)))
+        previous = current
+    return sorted(cells)
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import os
+import tempfile
 from pathlib import Path
 from typing import Any, Iterable
 from uuid import UUID
@@ -11,12 +12,20 @@ import orjson
 from redis import Redis
 from rq import Connection, Queue, Worker, get_current_job
 
+import geo
+import tiles
 from config import settings
+from db import init_connection
+from fit import build_fit
 from gpx import build_gpx
-from queries import ROUTE_GEOJSON_SQL, SEARCH_SQL
+from queries import AMENITIES_BY_ID_SQL, CHANGE_WATERMARK_SQL, MVT_SQL, ROUTE_SQL
+from search import search_amenities
+from tile_archive import MBTilesWriter, TileArchiveError, build_metadata
 
 GPX_RESULT_TTL = 60 * 60 * 24  # 24 hours
 QUEUE_NAME = "gpx"
+PYRAMID_CONCURRENCY = 4
+PYRAMID_BATCH_SIZE = 500
 
 
 def _parse_filters(filters: Iterable[str] | None) -> list[str] | None:
@@ -26,31 +35,61 @@ def _parse_filters(filters: Iterable[str] | None) -> list[str] | None:
     return filtered or None
 
 
+async def _selected_pois(
+    conn: asyncpg.Connection,
+    coordinates: list[list[float]],
+    radius_m: float,
+    categories: list[str] | None,
+    poi_ids: set[str],
+) -> list[dict[str, Any]]:
+    """Load explicitly selected amenities and keep those within the radius."""
+
+    rows = await conn.fetch(AMENITIES_BY_ID_SQL, [UUID(poi_id) for poi_id in poi_ids])
+    if categories:
+        rows = [row for row in rows if row["category"] in categories]
+    if not rows:
+        return []
+    points = [row["geom"].coords for row in rows]
+    dists, _ = geo.locate([p[0] for p in points], [p[1] for p in points], geo.as_line(coordinates))
+    selected = [
+        {
+            "id": str(row["id"]),
+            "category": row["category"],
+            "props": row["props"],
+            "distance_m": dist_m,
+            "geometry": row["geom"].geojson(),
+        }
+        for row, dist_m in zip(rows, dists.tolist())
+        if dist_m <= radius_m
+    ]
+    return sorted(selected, key=lambda poi: (poi["distance_m"], poi["id"]))
+
+
 async def _fetch_route_and_pois(
     route_id: UUID,
     radius_m: float,
     filters: Iterable[str] | None,
     conn: asyncpg.Connection,
+    poi_ids: set[str] | None = None,
 ) -> tuple[dict[str, Any], list[dict[str, Any]]]:
-    route_row = await conn.fetchrow(ROUTE_GEOJSON_SQL, route_id)
+    route_row = await conn.fetchrow(ROUTE_SQL, route_id)
     if route_row is None:
         raise ValueError("Route not found")
 
-    route_geojson = json.loads(route_row["geojson"])
+    route_geojson = route_row["geom"].geojson()
     route = {
         "route_id": str(route_row["route_id"]),
         "name": route_row["name"],
         "geometry": route_geojson,
-        "coordinates": route_geojson.get("coordinates", []),
+        "coordinates": route_geojson["coordinates"],
     }
 
     categories = _parse_filters(filters)
-    pois_rows = await conn.fetch(
-        SEARCH_SQL,
-        route_id,
-        radius_m,
-        categories,
-    )
+    if poi_ids:
+        # A handful of picked POIs: measure them in process instead of
+        # searching the whole corridor and discarding the rest.
+        return route, await _selected_pois(conn, route["coordinates"], radius_m, categories, poi_ids)
+    pois_rows = await search_amenities(conn, route_id, radius_m, categories)
 
     pois: list[dict[str, Any]] = []
     for row in pois_rows:
@@ -60,7 +99,7 @@ async def _fetch_route_and_pois(
                 "category": row["category"],
                 "props": row["props"],
                 "distance_m": float(row["dist_m"]) if row["dist_m"] is not None else None,
-                "geometry": json.loads(row["geojson"]),
+                "geometry": row["geom"].geojson(),
             }
         )
 
@@ -77,6 +116,7 @@ def process_gpx_job(payload: dict[str, Any]) -> str:
     radius_m = float(payload.get("radius_m", 500))
     filters = payload.get("filters") or None
     poi_ids = set(payload.get("poi_ids") or [])
+    export_format = payload.get("format") or "gpx"
 
     async def runner() -> tuple[dict[str, Any], list[dict[str, Any]]]:
         conn = await asyncpg.connect(
@@ -86,21 +126,22 @@ def process_gpx_job(payload: dict[str, Any]) -> str:
             password=settings.postgres_password,
         )
         try:
-            route, pois = await _fetch_route_and_pois(route_id, radius_m, filters, conn)
+            await init_connection(conn)
+            route, pois = await _fetch_route_and_pois(route_id, radius_m, filters, conn, poi_ids)
         finally:
             await conn.close()
         return route, pois
 
     route, pois = asyncio.run(runner())
 
-    if poi_ids:
-        pois = [poi for poi in pois if poi["id"] in poi_ids]
-
     output_dir = Path(settings.gpx_output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    output_path = output_dir / f"{job_id}.gpx"
+    output_path = output_dir / f"{job_id}.{export_format}"
 
-    build_gpx(route, pois, output_path)
+    if export_format == "fit":
+        build_fit(route, pois, output_path)
+    else:
+        build_gpx(route, pois, output_path)
 
     result_url = f"/files/{output_path.name}"
     redis_conn = Redis.from_url(settings.redis_url)
@@ -110,6 +151,75 @@ def process_gpx_job(payload: dict[str, Any]) -> str:
     return result_url
 
 
+async def _render_pyramid(bbox: list[float], min_zoom: int, max_zoom: int, output_path: Path) -> None:
+    pool = await asyncpg.create_pool(
+        host=settings.postgres_host,
+        database=settings.postgres_db,
+        user=settings.postgres_user,
+        password=settings.postgres_password,
+        min_size=1,
+        max_size=PYRAMID_CONCURRENCY,
+    )
+    try:
+        # Read the freshness markers before rendering so any edit that lands
+        # mid-render is newer than the watermark and bypasses the archive.
+        version = await pool.fetchval("SELECT version FROM dataset_versions WHERE name = 'amenities'")
+        watermark = await pool.fetchval(CHANGE_WATERMARK_SQL)
+
+        writer = MBTilesWriter(output_path)
+        semaphore = asyncio.Semaphore(PYRAMID_CONCURRENCY)
+
+        async def render(z: int, x: int, y: int) -> tuple[int, int, int, bytes]:
+            async with semaphore:
+                row = await pool.fetchrow(MVT_SQL, z, x, y, None)
+            return z, x, y, (row["st_asmvt"] if row and row["st_asmvt"] else b"")
+
+        batch: list[tuple[int, int, int]] = []
+        for z in range(min_zoom, max_zoom + 1):
+            xs, ys = tiles.tile_range(bbox, z)
+            for x in xs:
+                for y in ys:
+                    batch.append((z, x, y))
+                    if len(batch) >= PYRAMID_BATCH_SIZE:
+                        writer.add_tiles(await asyncio.gather(*(render(*t) for t in batch)))
+                        batch = []
+        if batch:
+            writer.add_tiles(await asyncio.gather(*(render(*t) for t in batch)))
+
+        writer.finish(build_metadata(bbox, min_zoom, max_zoom, version or 0, watermark))
+    finally:
+        await pool.close()
+
+
+def render_tile_pyramid(payload: dict[str, Any]) -> str:
+    """Render every amenities tile in a bbox and zoom range into an MBTiles archive."""
+
+    bbox = [float(v) for v in payload["bbox"]]
+    min_zoom = int(payload.get("min_zoom", 0))
+    max_zoom = int(payload.get("max_zoom", 14))
+    if len(bbox) != 4 or not tiles.valid_bbox(bbox) or min_zoom < 0 or max_zoom < min_zoom:
+        raise TileArchiveError("Invalid bbox or zoom range")
+    if tiles.pyramid_tile_count(bbox, min_zoom, max_zoom) > settings.mvt_pyramid_max_tiles:
+        raise TileArchiveError("Tile pyramid exceeds MVT_PYRAMID_MAX_TILES")
+    if not settings.mvt_archive_path:
+        raise TileArchiveError("MVT_ARCHIVE_PATH is not configured")
+
+    output_path = Path(settings.mvt_archive_path)
+    # Render next to the live archive and swap atomically; API processes
+    # notice the new inode and reopen it. Each job gets its own temp file so
+    # concurrent workers never write into the same SQLite file.
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=output_path.parent, prefix=output_path.name + ".", suffix=".tmp")
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    try:
+        asyncio.run(_render_pyramid(bbox, min_zoom, max_zoom, tmp_path))
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return str(output_path)
+
+
 def run_worker() -> None:
     redis_conn = Redis.from_url(settings.redis_url)
     with Connection(redis_conn):